@@ -0,0 +1,74 @@
+"""
+Latency of POST /allocate, one request at a time through the Flask test
+client, against each database the API can be deployed on:
+
+    sqlite           a temporary file, tuned as in the SQLite deployment
+                     mode (WAL, synchronous=NORMAL, BEGIN IMMEDIATE...)
+    sqlite-untuned   the same, with SQLAlchemy's and SQLite's defaults
+    postgres         config.get_postgres_uri(), skipped if unreachable
+
+    python benchmarks/bench_allocate.py [requests]
+"""
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+from allocation import config
+from allocation.adapters import orm, sqlite
+from allocation.service_layer import unit_of_work
+
+
+def percentile(sorted_values, p):
+    return sorted_values[max(round(p / 100 * len(sorted_values)) - 1, 0)]
+
+
+def engines():
+    directory = tempfile.mkdtemp()
+    uri = f"sqlite:///{os.path.join(directory, 'tuned.db')}"
+    yield 'sqlite', sqlite.make_engine(uri), sqlite.make_engine(uri, writer=False)
+    untuned = create_engine(f"sqlite:///{os.path.join(directory, 'untuned.db')}")
+    orm.metadata.create_all(untuned)
+    yield 'sqlite-untuned', untuned, untuned
+    postgres = create_engine(config.get_postgres_uri())
+    try:
+        orm.metadata.create_all(postgres)
+    except OperationalError:
+        print('postgres: unreachable, skipped')
+        return
+    yield 'postgres', postgres, postgres
+
+
+def run(client, requests):
+    sku = f'sku-{uuid.uuid4().hex[:8]}'
+    client.post('/add_batch', json=dict(
+        ref=f'batch-{uuid.uuid4().hex[:8]}', sku=sku, qty=requests, eta=None))
+    latencies = []
+    for i in range(requests):
+        start = time.perf_counter()
+        r = client.post('/allocate', json=dict(orderid=f'order-{i}', sku=sku, qty=1))
+        latencies.append(time.perf_counter() - start)
+        assert r.status_code == 201, r.json
+    return sorted(latencies)
+
+
+def main(requests=1000):
+    from allocation.entrypoints.flask_app import app  # starts the mappers
+    client = app.test_client()
+    print(f'{"database":<16}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"req/s":>10}')
+    for name, primary, readers in engines():
+        unit_of_work.DEFAULT_SESSION_FACTORY.configure(bind=primary)
+        unit_of_work.REPLICA_SESSION_FACTORY.configure(bind=readers)
+        run(client, 50)  # warm up the pools and caches
+        latencies = run(client, requests)
+        print(f'{name:<16}' + ''.join(
+            f'{percentile(latencies, p) * 1000:>10.2f}' for p in (50, 95, 99))
+            + f'{len(latencies) / sum(latencies):>10.0f}')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,58 @@
+"""
+Per-call overhead of the repository's hot queries on sqlite, built with
+session.query() on every call (before) vs baked (after).
+
+    python benchmarks/bench_repository.py [calls]
+"""
+import sys
+import timeit
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocation.adapters import orm, repository
+from allocation.domain import model
+
+
+def uncached_queries(session):
+    return {
+        # FOR UPDATE like the repository's get, though sqlite ignores it
+        'get': lambda: session.query(model.Batch).filter_by(
+            ref='batch-1').with_for_update().one(),
+        'list_for_sku': lambda: session.query(model.Batch).filter_by(sku='sku-1').all(),
+        'list_for_order': lambda: session.query(model.Batch).join(
+            model.Batch._allocations).filter(model.OrderLine.orderid == 'order-1').all(),
+    }
+
+
+def baked_queries(session):
+    repo = repository.SQLAlchemyRepository(session)
+    return {
+        'get': lambda: repo.get('batch-1'),
+        'list_for_sku': lambda: repo.list_for_sku('sku-1'),
+        'list_for_order': lambda: repo.list_for_order('order-1'),
+    }
+
+
+def main(calls=2000):
+    engine = create_engine('sqlite:///:memory:')
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    session = sessionmaker(bind=engine)()
+    for i in range(100):
+        batch = model.Batch(f'batch-{i}', f'sku-{i % 10}', 100)
+        batch.allocate(model.OrderLine(f'order-{i}', f'sku-{i % 10}', 1))
+        session.add(batch)
+    session.commit()
+
+    before, after = uncached_queries(session), baked_queries(session)
+    print(f'{"query":<16}{"before (us)":>14}{"after (us)":>14}{"speedup":>10}')
+    for name in before:
+        t_before = min(timeit.repeat(before[name], number=calls, repeat=3)) / calls
+        t_after = min(timeit.repeat(after[name], number=calls, repeat=3)) / calls
+        print(f'{name:<16}{t_before * 1e6:>14.1f}{t_after * 1e6:>14.1f}'
+              f'{t_before / t_after:>9.2f}x')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,207 @@
+"""
+Concurrent load test of the allocation API.
+
+Drives POST /add_batch and POST /allocate from many client threads, with
+a configurable request mix and a share of the traffic going to a few hot
+SKUs, and reports throughput, latency percentiles and errors by type.
+
+Against the docker-compose stack (make up), at config.get_api_url():
+
+    python benchmarks/loadtest.py --clients 200 --requests 20000
+
+Against an in-process server backed by a temporary sqlite file, set up
+as in the SQLite deployment mode, or by any other database:
+
+    python benchmarks/loadtest.py --in-process --clients 50
+    python benchmarks/loadtest.py --in-process --database-uri postgresql://...
+"""
+import argparse
+import collections
+import logging
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+
+from allocation import config
+
+# The API only returns a message for domain errors; map it back to the
+# exception that produced it.
+ERROR_MESSAGES = {
+    'Out of stock': 'OutOfStock',
+    'Invalid SKU': 'InvalidSKU',
+    'Unallocated SKU': 'UnallocatedSKU',
+}
+
+
+def parse_mix(mix):
+    weights = dict(part.split('=') for part in mix.split(','))
+    return {name: float(weight) for name, weight in weights.items()}
+
+
+def percentile(sorted_values, p):
+    # nearest-rank
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)]
+
+
+def error_type(response):
+    try:
+        message = response.json().get('message', '')
+    except ValueError:
+        message = ''
+    for prefix, name in ERROR_MESSAGES.items():
+        if message.startswith(prefix):
+            return name
+    return f'HTTP {response.status_code}'
+
+
+class Workload:
+
+    def __init__(self, args):
+        self.skus = [f'sku-{i}-{uuid.uuid4().hex[:6]}' for i in range(args.skus)]
+        self.hot = self.skus[:args.hot_skus]
+        self.hot_share = args.hot_share
+        self.mix = parse_mix(args.mix)
+        self.batch_qty = args.batch_qty
+
+    def pick_sku(self):
+        if self.hot and random.random() < self.hot_share:
+            return random.choice(self.hot)
+        return random.choice(self.skus)
+
+    def next_request(self):
+        kind = random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        sku = self.pick_sku()
+        if kind == 'add_batch':
+            return kind, dict(ref=f'batch-{uuid.uuid4().hex[:10]}', sku=sku,
+                              qty=self.batch_qty, eta=None)
+        return kind, dict(orderid=f'order-{uuid.uuid4().hex[:10]}', sku=sku,
+                          qty=random.randint(1, 10))
+
+    def seed(self, url):
+        for sku in self.skus:
+            r = requests.post(f'{url}/add_batch', json=dict(
+                ref=f'batch-{uuid.uuid4().hex[:10]}', sku=sku,
+                qty=self.batch_qty, eta=None))
+            r.raise_for_status()
+
+
+class Results:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+    def record(self, kind, latency, error=None):
+        with self.lock:
+            self.latencies[kind].append(latency)
+            if error:
+                self.errors[f'{kind}: {error}'] += 1
+
+    def report(self, elapsed):
+        total = sum(len(v) for v in self.latencies.values())
+        print(f'{total} requests in {elapsed:.2f}s: {total / elapsed:.1f} req/s')
+        print(f'{"endpoint":<12}{"count":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+        rows = dict(self.latencies)
+        rows['all'] = [x for v in self.latencies.values() for x in v]
+        for kind, values in rows.items():
+            values = sorted(values)
+            print(f'{kind:<12}{len(values):>8}' + ''.join(
+                f'{percentile(values, p) * 1000:>10.1f}' for p in (50, 95, 99)))
+        if self.errors:
+            print('errors:')
+            for name, count in self.errors.most_common():
+                print(f'  {name:<40}{count:>8}')
+
+
+def client(url, workload, results, remaining):
+    session = requests.Session()
+    while True:
+        with remaining['lock']:
+            if remaining['n'] <= 0:
+                return
+            remaining['n'] -= 1
+        kind, data = workload.next_request()
+        start = time.perf_counter()
+        try:
+            r = session.post(f'{url}/{kind}', json=data, timeout=30)
+            error = None if r.status_code == 201 else error_type(r)
+        except requests.RequestException as exc:
+            error = type(exc).__name__
+        results.record(kind, time.perf_counter() - start, error)
+
+
+def start_in_process_server(uri=None):
+    """
+    Serves the Flask app from a thread, against `uri` or a temporary
+    sqlite file.
+    """
+    from werkzeug.serving import make_server
+    from allocation.adapters import orm
+    from allocation.service_layer import unit_of_work
+
+    os.environ['DATABASE_URI'] = uri or 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'allocation.db')
+    engine = unit_of_work.make_engine()
+    orm.metadata.create_all(engine)
+    unit_of_work.DEFAULT_SESSION_FACTORY.configure(bind=engine)
+    unit_of_work.REPLICA_SESSION_FACTORY.configure(
+        bind=unit_of_work.make_replica_engine() or engine)
+    from allocation.entrypoints.flask_app import app
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # no access log
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}', server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--url', default=None, help='defaults to config.get_api_url()')
+    parser.add_argument('--in-process', action='store_true')
+    parser.add_argument('--database-uri', default=None,
+                        help='for --in-process, defaults to a temporary sqlite file')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--mix', default='allocate=9,add_batch=1')
+    parser.add_argument('--skus', type=int, default=100)
+    parser.add_argument('--hot-skus', type=int, default=5)
+    parser.add_argument('--hot-share', type=float, default=0.8,
+                        help='share of requests going to the hot SKUs')
+    parser.add_argument('--batch-qty', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    server = None
+    if args.in_process:
+        url, server = start_in_process_server(args.database_uri)
+    else:
+        url = args.url or config.get_api_url()
+
+    workload = Workload(args)
+    workload.seed(url)
+    results = Results()
+    remaining = dict(n=args.requests, lock=threading.Lock())
+    threads = [
+        threading.Thread(target=client, args=(url, workload, results, remaining))
+        for _ in range(args.clients)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    results.report(time.perf_counter() - start)
+    if server:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
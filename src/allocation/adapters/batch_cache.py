@@ -0,0 +1,54 @@
+"""
+Process-wide cache of the hydrated Batches of a SKU, allocations included.
+
+Entries are detached from any session. They are only handed out when the
+version token stored with them still matches the database's, and are
+merged into the unit of work's session without querying.
+"""
+import threading
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Tuple
+
+from allocation import metrics
+from allocation.domain import model
+
+
+class BatchCache:
+
+    def __init__(self, max_skus: int = 1024, max_lines: int = 100_000):
+        self.max_skus = max_skus
+        self.max_lines = max_lines
+        self._entries: 'OrderedDict[str, Tuple[Hashable, List[model.Batch], int]]' = OrderedDict()
+        self._lines = 0
+        self._lock = threading.Lock()
+
+    def get(self, sku: str, token: Hashable) -> Optional[List[model.Batch]]:
+        with self._lock:
+            entry = self._entries.get(sku)
+            if entry is None or entry[0] != token:
+                metrics.increment('batch_cache.misses')
+                return None
+            self._entries.move_to_end(sku)
+        metrics.increment('batch_cache.hits')
+        return entry[1]
+
+    def put(self, sku: str, token: Hashable, batches: List[model.Batch]) -> None:
+        size = sum(len(b._allocations) + 1 for b in batches)
+        with self._lock:
+            self._remove(sku)
+            self._entries[sku] = (token, batches, size)
+            self._lines += size
+            # least recently used first
+            while self._entries and (
+                len(self._entries) > self.max_skus or self._lines > self.max_lines
+            ):
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, sku: str) -> None:
+        with self._lock:
+            self._remove(sku)
+
+    def _remove(self, sku):
+        entry = self._entries.pop(sku, None)
+        if entry is not None:
+            self._lines -= entry[2]
@@ -0,0 +1,53 @@
+"""
+Append-only log of the commands the API handled, for replaying a day's
+traffic against new code (see entrypoints/replay.py).
+
+One compact JSON object per line: when the command arrived ('t', unix
+seconds) and when it completed ('d'), its name ('c'), its arguments as
+received ('a') and what it returned ('o'), e.g.
+
+    {"t":1700000000.123,"d":1700000000.131,"c":"allocate","a":{"orderid":"o1","sku":"LAMP","qty":2},"o":"b1"}
+
+Lines are written as commands complete, so they're in 'd' order; sort
+them by 't' for the order they arrived in. Errors, expected or not, are
+recorded as {"error": <exception class name>}.
+"""
+import json
+import threading
+import time
+from typing import Any, Iterator, Optional
+
+
+class CommandLog:
+
+    def __init__(self, path: str):
+        self.path = path
+        # in append mode each line is written at the end of the file, even
+        # when the prefork workers share it
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def record(self, at: float, command: str, args: dict, outcome: Any,
+               done: Optional[float] = None) -> None:
+        done = time.time() if done is None else done
+        line = json.dumps(
+            {'t': round(at, 3), 'd': round(done, 3), 'c': command, 'a': args, 'o': outcome},
+            separators=(',', ':'), default=str,
+        ) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def error(exc: Exception) -> dict:
+    return {'error': type(exc).__name__}
+
+
+def read(path: str) -> Iterator[dict]:
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
@@ -1,7 +1,10 @@
+from datetime import datetime
 from sqlalchemy import (
-    MetaData, Table, Column, Integer, String, Date, ForeignKey
+    MetaData, Table, Column, Index, Integer, String, Date, DateTime, Text, ForeignKey,
+    event, func
 )
-from sqlalchemy.orm import mapper, relationship
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import mapper, object_session, relationship
 from allocation.domain import model
 
 # https://docs.sqlalchemy.org/en/13/core/metadata.html#sqlalchemy.schema.MetaData
@@ -15,35 +18,124 @@ order_lines = Table(
     Column('sku', String(255)),
     Column('qty', Integer, nullable=False),
     Column('orderid', String(255)),
+    # for finding a line's allocations, see repository.is_allocated
+    Index('ix_order_lines_orderid_sku', 'orderid', 'sku'),
 )
 
 batches = Table(
     'batches', metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
     Column('ref', String(255)),
-    Column('sku', String(255)),
+    # batches are looked up, locked and cached by SKU
+    Column('sku', String(255), index=True),
     Column('_qty', Integer, nullable=False),
     Column('eta', Date, nullable=True),
+    # Batch.available_qty persisted, for single-statement allocations.
+    # NULL when unknown, e.g. for rows written outside the ORM.
+    Column('available_qty', Integer, nullable=True),
+    # bumped on every change, for cheap checks that cached Batches are current
+    Column('version', Integer, nullable=False, server_default='1'),
+    # ids are kept when archived, so must never be reused; sqlite reuses
+    # the highest id once its row is deleted, unless told not to
+    sqlite_autoincrement=True,
 )
 
 allocations = Table(
     'allocations', metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('orderline_id', ForeignKey('order_lines.id'), index=True),
+    # for summing a batch's allocations (see repository.available)
+    Column('batch_id', ForeignKey('batches.id'), index=True),
+    Column('created_at', DateTime, nullable=False,
+           default=datetime.utcnow, server_default=func.now()),
+    # unconfirmed allocations are released by the expiry sweeper after this
+    Column('expires_at', DateTime, nullable=True, index=True),
+    sqlite_autoincrement=True,  # see batches
+)
+
+# Fully consumed batches whose ETA has passed are moved out of the
+# tables above into these, with their allocations and ids, to keep the
+# hot set that allocations load small.
+batches_archive = Table(
+    'batches_archive', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('ref', String(255)),
+    Column('sku', String(255)),
+    Column('_qty', Integer, nullable=False),
+    Column('eta', Date, nullable=True),
+    Column('archived_at', DateTime, nullable=False, default=func.now()),
+)
+
+allocations_archive = Table(
+    'allocations_archive', metadata,
+    Column('id', Integer, primary_key=True),
     Column('orderline_id', ForeignKey('order_lines.id')),
-    Column('batch_id', ForeignKey('batches.id')),
+    Column('batch_id', ForeignKey('batches_archive.id')),
+    Column('created_at', DateTime, nullable=True),
+    Column('expires_at', DateTime, nullable=True),
 )
 
+# Transactional outbox: events are inserted in the same transaction as
+# the allocations that raised them, and published once it has committed.
+outbox = Table(
+    'outbox', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('sku', String(255), nullable=False),
+    Column('type', String(255), nullable=False),
+    Column('payload', Text, nullable=False),
+    Column('created_at', DateTime, nullable=False, default=datetime.utcnow),
+    Column('published_at', DateTime, nullable=True, index=True),
+)
+
+# https://docs.sqlalchemy.org/en/13/orm/extensions/baked.html
+# A bakery caches the Query objects built by the lambdas passed to it,
+# keyed on the lambdas' code, along with their compiled SQL. Those refer
+# to the mappers they were built against, so it's (re)created together
+# with them in start_mappers.
+bakery = baked.bakery()
+
 def start_mappers():
+    global bakery
+    bakery = baked.bakery()
     lines_mapper = mapper(model.OrderLine, order_lines)  # returns Mapper object that defines correlation
     # of class attrs to ddbb table columns. When mapper() is used explicitly to link a user defined
     # class with table metadata, this is referred to as classical mapping.
     # https://docs.sqlalchemy.org/en/13/orm/mapping_api.html#sqlalchemy.orm.mapper.params.properties
     # https://docs.sqlalchemy.org/en/13/orm/relationship_api.html#sqlalchemy.orm.relationship
-    mapper(model.Batch, batches, properties={
+    batches_mapper = mapper(model.Batch, batches, properties={
         '_allocations': relationship(
             lines_mapper,  # mapped class or Mapper instance representing relationship target
             secondary=allocations, # intermediary junction table to link two tables
             collection_class=set,  # will be used in place of default list() for storing elems
-        )
-    })
+        ),
+        # mapped under another name, Batch.available_qty is a property
+        '_available_qty': batches.c.available_qty,
+        '_version': batches.c.version,
+    # UPDATEs of a Batch are conditional on the version it was loaded at,
+    # which they bump. A writer that loaded a Batch before someone else
+    # changed it (another session, or allocate_fast in SQL) fails with
+    # StaleDataError rather than overwriting their change.
+    # https://docs.sqlalchemy.org/en/13/orm/versioning.html
+    }, version_id_col=batches.c.version)
+    # https://docs.sqlalchemy.org/en/13/orm/events.html#sqlalchemy.orm.events.MapperEvents.before_update
+    # before_update is called for every dirty Batch, including those whose
+    # only change is to their _allocations collection, so the persisted
+    # available_qty follows every change made through the ORM.
+    event.listen(batches_mapper, 'before_insert', _before_insert)
+    event.listen(batches_mapper, 'before_update', _before_update)
+
+
+def _before_insert(mapper, connection, batch):
+    batch._available_qty = batch.available_qty
+    _written(batch)
+
+
+def _before_update(mapper, connection, batch):
+    batch._available_qty = batch.available_qty
+    _written(batch)
+
+
+def _written(batch):
+    # the SKUs written by a session, for caches to invalidate on commit
+    object_session(batch).info.setdefault('written_skus', set()).add(batch.sku)
 
@@ -0,0 +1,107 @@
+import json
+import queue
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import asdict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, select
+
+from allocation.adapters import orm
+from allocation.domain import events
+
+# A published message, as handed to publishers:
+# {'id': ..., 'type': 'Allocated', 'sku': ..., 'payload': {...}, 'created_at': ...}
+Message = Dict
+
+
+class AbstractOutbox(ABC):
+
+    @abstractmethod
+    def add(self, event: events.Event):
+        raise NotImplementedError
+
+
+class SQLAlchemyOutbox(AbstractOutbox):
+
+    def __init__(self, session):
+        self.session = session
+
+    def add(self, event):
+        # Core insert in the session's transaction: it commits or rolls
+        # back together with the allocations
+        self.session.execute(orm.outbox.insert().values(
+            sku=event.sku,
+            type=type(event).__name__,
+            payload=json.dumps(asdict(event)),
+        ))
+
+    def unpublished(self, limit) -> List[Message]:
+        # ordered by id, which follows commit order per SKU since the rows
+        # of a SKU are written while holding its batches' lock
+        rows = self.session.execute(
+            select([orm.outbox])
+            .where(orm.outbox.c.published_at.is_(None))
+            .order_by(orm.outbox.c.id)
+            .limit(limit)
+        ).fetchall()
+        return [
+            dict(
+                id=row.id,
+                type=row.type,
+                sku=row.sku,
+                payload=json.loads(row.payload),
+                created_at=row.created_at.isoformat(),
+            )
+            for row in rows
+        ]
+
+    def mark_published(self, ids, at: datetime):
+        self.session.execute(
+            orm.outbox.update()
+            .where(orm.outbox.c.id.in_(ids))
+            .values(published_at=at)
+        )
+
+    def pending(self):
+        """Count and creation time of the oldest of the unpublished messages."""
+        return self.session.execute(
+            select([func.count(orm.outbox.c.id), func.min(orm.outbox.c.created_at)])
+            .where(orm.outbox.c.published_at.is_(None))
+        ).first()
+
+
+class AbstractPublisher(ABC):
+
+    @abstractmethod
+    def publish(self, messages: List[Message]):
+        """
+        Delivers messages in the order given. Raising means none of them
+        counts as delivered, so they will all be published again.
+        """
+        raise NotImplementedError
+
+
+class FilePublisher(AbstractPublisher):
+    """Appends messages as JSON lines to a local file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def publish(self, messages):
+        with self._lock, open(self.path, 'a') as f:
+            f.writelines(json.dumps(m) + '\n' for m in messages)
+            f.flush()
+
+
+class QueuePublisher(AbstractPublisher):
+    """Puts messages on an in-process queue."""
+
+    def __init__(self, q: Optional[queue.Queue] = None):
+        self.queue = q if q is not None else queue.Queue()
+
+    def publish(self, messages):
+        for m in messages:
+            self.queue.put(m)
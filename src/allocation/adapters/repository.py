@@ -1,4 +1,9 @@
 from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+from sqlalchemy import and_, bindparam, exists, func, or_, select
+from sqlalchemy.orm import selectinload
+from allocation.adapters import orm
 from allocation.domain import model
 
 class AbstractRepository(ABC):
@@ -11,20 +16,361 @@ class AbstractRepository(ABC):
     def get(self, reference) -> model.Batch:
         raise NotImplementedError
 
+    @abstractmethod
+    def get_many(self, references) -> List[model.Batch]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_for_sku(self, sku) -> List[model.Batch]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def skus(self) -> List[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def skus_version(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def has_archived(self, sku) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def is_allocated(self, line: model.OrderLine) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_expiry(self, line: model.OrderLine, expires_at: datetime):
+        raise NotImplementedError
+
+    @abstractmethod
+    def confirm(self, orderid) -> int:
+        raise NotImplementedError
+
+    def allocate_fast(self, line: model.OrderLine) -> Optional[str]:
+        """
+        Allocates a line without loading any Batch, when the first batch
+        of its SKU in ETA order can take it, returning the batch's ref.
+        None means the line must go through the domain model instead.
+        """
+        return None
+
+def _allocated_qty():
+    """Subquery of the quantity allocated per batch id."""
+    a, l = orm.allocations, orm.order_lines
+    return (
+        select([a.c.batch_id, func.sum(l.c.qty).label('qty')])
+        .select_from(a.join(l, a.c.orderline_id == l.c.id))
+        .group_by(a.c.batch_id)
+        .alias('allocated')
+    )
+
+def _allocated_qty_of(batch_id):
+    """Scalar subquery of the quantity allocated to `batch_id`, correlated."""
+    a, l = orm.allocations, orm.order_lines
+    return (
+        select([func.coalesce(func.sum(l.c.qty), 0)])
+        .select_from(a.join(l, a.c.orderline_id == l.c.id))
+        .where(a.c.batch_id == batch_id)
+        .as_scalar()
+    )
+
 class SQLAlchemyRepository(AbstractRepository):
 
-    def __init__(self, session):
+    def __init__(self, session, cache=None):
         self.session = session
+        self.cache = cache
 
     def add(self, batch):
         # https://docs.sqlalchemy.org/en/13/orm/session_api.html#sqlalchemy.orm.session.Session.add
         self.session.add(batch)  # places batch in the Session, its state will be persisted to the
         # ddbb on the next flush operation
 
+    # Hot queries are baked: built and compiled once per process, with
+    # values supplied as bound parameters (see orm.bakery)
     def get(self, reference):
-        return self.session.query(model.Batch).filter_by(
-            ref=reference).one()
+        # locked like in get_many, as it's only used to change the batch
+        query = orm.bakery(lambda session: session.query(model.Batch))
+        query += lambda q: q.filter_by(ref=bindparam('ref')).with_for_update()
+        return query(self.session).params(ref=reference).one()
+
+    def get_many(self, references):
+        """
+        The batches with these refs, and their allocations, in two queries
+        however many there are. They're locked FOR UPDATE, in id order so
+        that concurrent callers lock them in the same order.
+        """
+        query = orm.bakery(lambda session: session.query(model.Batch))
+        query += lambda q: q.filter(
+            model.Batch.ref.in_(bindparam('refs', expanding=True))
+        ).options(selectinload(model.Batch._allocations)).order_by(
+            model.Batch.id).with_for_update()
+        return query(self.session).params(refs=list(references)).all()
 
     def list(self):
-        return self.session.query(model.Batch).all()
+        query = orm.bakery(lambda session: session.query(model.Batch))
+        return query(self.session).all()
+
+    def list_for_sku(self, sku):
+        if self.cache is not None:
+            return self._list_for_sku_cached(sku)
+        query = orm.bakery(lambda session: session.query(model.Batch))
+        query += lambda q: q.filter_by(sku=bindparam('sku'))
+        return query(self.session).params(sku=sku).all()
+
+    def _version_token(self, sku):
+        # changes whenever a batch of the SKU is added, removed or updated
+        b = orm.batches
+        return tuple(self.session.execute(
+            select([func.count(b.c.id), func.sum(b.c.id), func.sum(b.c.version)])
+            .where(b.c.sku == sku)
+        ).first())
+
+    def _list_for_sku_cached(self, sku):
+        token = self._version_token(sku)
+        cached = self.cache.get(sku, token)
+        if cached is None:
+            query = orm.bakery(lambda session: session.query(model.Batch))
+            query += lambda q: q.filter_by(sku=bindparam('sku')).options(
+                selectinload(model.Batch._allocations))
+            loaded = query(self.session).params(sku=sku).all()
+            # detach the loaded graph for the cache...
+            for batch in loaded:
+                for line in batch._allocations:
+                    self.session.expunge(line)
+                self.session.expunge(batch)
+            # nothing to save a query on for an unknown SKU, and caching
+            # them would let made-up SKUs evict the real ones
+            if loaded:
+                self.cache.put(sku, token, loaded)
+            cached = loaded
+        # ...and work on copies of it. With load=False, merge copies the
+        # state it's given, allocations included, without any SQL.
+        # https://docs.sqlalchemy.org/en/13/orm/session_api.html#sqlalchemy.orm.session.Session.merge
+        return [self.session.merge(batch, load=False) for batch in cached]
+
+    def list_for_order(self, orderid):
+        """Batches with at least one line of the order allocated to them."""
+        query = orm.bakery(lambda session: session.query(model.Batch))
+        query += lambda q: q.join(model.Batch._allocations).filter(
+            model.OrderLine.orderid == bindparam('orderid'))
+        return query(self.session).params(orderid=orderid).all()
+
+    def skus(self):
+        """The SKUs we stock, or did until their batches were archived."""
+        b, archived = orm.batches, orm.batches_archive
+        return [row.sku for row in self.session.execute(
+            select([b.c.sku]).union(select([archived.c.sku])))]
+
+    def skus_version(self):
+        """
+        Changes whenever a batch, and so maybe a SKU, is added. The count
+        too, for batches that commit after one with a higher id.
+        """
+        b = orm.batches
+        return tuple(self.session.execute(
+            select([func.count(b.c.id), func.max(b.c.id)])).first())
+
+    def has_archived(self, sku):
+        archived = orm.batches_archive
+        return self.session.execute(select([exists().where(archived.c.sku == sku)])).scalar()
+
+    def lock(self, sku):
+        # SELECT ... FOR UPDATE: other transactions locking or updating the
+        # batches of this SKU block until we commit or roll back. Dialects
+        # without row locks (sqlite) render a plain SELECT.
+        # https://docs.sqlalchemy.org/en/13/core/selectable.html#sqlalchemy.sql.expression.Select.with_for_update
+        self.session.execute(
+            select([orm.batches.c.id])
+            .where(orm.batches.c.sku == sku)
+            .with_for_update()
+        ).fetchall()
+
+    def allocate_fast(self, line):
+        b, a, l = orm.batches, orm.allocations, orm.order_lines
+        if self.is_allocated(line):
+            return None  # let the domain model decide, it's idempotent
+        # the batch allocate() would try first: earliest ETA, in stock first
+        first = (
+            select([b.c.id])
+            .where(b.c.sku == line.sku)
+            .order_by(b.c.eta.nullsfirst(), b.c.id)
+            .limit(1)
+        )
+        decrement = (
+            b.update()
+            .values(available_qty=b.c.available_qty - line.qty, version=b.c.version + 1)
+            .where(b.c.available_qty >= line.qty)
+        )
+        if self.session.get_bind().dialect.implicit_returning:
+            # UPDATE ... WHERE id = (SELECT ...) ... RETURNING in one statement
+            row = self.session.execute(
+                decrement.where(b.c.id == first.as_scalar())
+                .returning(b.c.id, b.c.ref)
+            ).first()
+        else:
+            # sqlite (for SQLAlchemy 1.3) has no RETURNING: select the batch,
+            # then decrement it only if it still has enough available
+            row = self.session.execute(select([b.c.id, b.c.ref]).where(
+                b.c.id == first.as_scalar())).first()
+            if row and not self.session.execute(decrement.where(b.c.id == row.id)).rowcount:
+                row = None
+        if row is None:
+            return None  # not enough in the first batch, NULL available_qty, or no batch
+        orderline_id = self.session.execute(l.insert().values(
+            orderid=line.orderid, sku=line.sku, qty=line.qty,
+        )).inserted_primary_key[0]
+        self.session.execute(a.insert().values(orderline_id=orderline_id, batch_id=row.id))
+        return row.ref
+
+    def is_allocated(self, line):
+        a, l = orm.allocations, orm.order_lines
+        return self.session.execute(select([exists().where(and_(
+            l.c.orderid == line.orderid, l.c.sku == line.sku, l.c.qty == line.qty,
+            a.c.orderline_id == l.c.id,
+        ))])).scalar()
+
+    def set_expiry(self, line, expires_at):
+        """
+        Releases the allocation of a line at `expires_at`, unless confirmed
+        before. For a line allocated in this unit of work only: a line that
+        was allocated already keeps its allocation as it was.
+        """
+        a, l = orm.allocations, orm.order_lines
+        self.session.flush()  # the allocation may only be in the session yet
+        self.session.execute(
+            a.update()
+            .where(a.c.orderline_id.in_(select([l.c.id]).where(and_(
+                l.c.orderid == line.orderid, l.c.sku == line.sku, l.c.qty == line.qty,
+            ))))
+            .values(expires_at=expires_at)
+        )
+
+    def confirm(self, orderid):
+        """Stops the allocations of an order expiring, returns how many."""
+        a, l = orm.allocations, orm.order_lines
+        return self.session.execute(
+            a.update()
+            .where(a.c.orderline_id.in_(select([l.c.id]).where(l.c.orderid == orderid)))
+            .where(a.c.expires_at.isnot(None))
+            .values(expires_at=None)
+        ).rowcount
+
+    def release_expired(self, now, limit) -> List[Tuple[model.OrderLine, str]]:
+        """
+        Deletes up to `limit` allocations that expired by `now`, giving
+        their quantity back to their batches, in a few set-based statements
+        rather than Batch.deallocate for each. Returns the lines released,
+        with the ref of the batch each was allocated to.
+        """
+        b, a, l = orm.batches, orm.allocations, orm.order_lines
+        expired = self.session.execute(
+            select([a.c.id, a.c.batch_id])
+            .where(a.c.expires_at <= now)
+            .order_by(a.c.expires_at, a.c.id)
+            .limit(limit)
+        ).fetchall()
+        if not expired:
+            return []
+        # lock the batches in id order, as get_many does, so as not to
+        # deadlock with it...
+        self.session.execute(
+            select([b.c.id])
+            .where(b.c.id.in_({row.batch_id for row in expired}))
+            .order_by(b.c.id)
+            .with_for_update()
+        ).fetchall()
+        # ...then read again what someone else may have changed meanwhile
+        rows = self.session.execute(
+            select([a.c.id, a.c.batch_id, l.c.orderid, l.c.sku, l.c.qty, b.c.ref])
+            .select_from(a.join(l, a.c.orderline_id == l.c.id)
+                         .join(b, a.c.batch_id == b.c.id))
+            .where(a.c.id.in_([row.id for row in expired]))
+            .where(a.c.expires_at <= now)
+        ).fetchall()
+        if not rows:
+            return []
+        ids = [row.id for row in rows]
+        # like allocate_fast, keep available_qty and version current
+        freed = (
+            select([func.sum(l.c.qty)])
+            .select_from(a.join(l, a.c.orderline_id == l.c.id))
+            .where(and_(a.c.batch_id == b.c.id, a.c.id.in_(ids)))
+            .as_scalar()
+        )
+        self.session.execute(
+            b.update()
+            .where(b.c.id.in_({row.batch_id for row in rows}))
+            .values(available_qty=b.c.available_qty + freed, version=b.c.version + 1)
+        )
+        self.session.execute(a.delete().where(a.c.id.in_(ids)))
+        return [(model.OrderLine(row.orderid, row.sku, row.qty), row.ref) for row in rows]
+
+    def available(self, after, limit) -> List[Dict]:
+        """
+        A page of batches with their available quantity computed in SQL,
+        keyset paginated on id: the batches with an id after `after`.
+        """
+        b = orm.batches
+        # summed per row of the page, through the allocations' batch_id
+        # index, rather than grouping the whole allocations table
+        rows = self.session.execute(
+            select([
+                b.c.id, b.c.ref, b.c.sku, b.c.eta,
+                (b.c._qty - _allocated_qty_of(b.c.id)).label('available_qty'),
+            ])
+            .where(b.c.id > after)
+            .order_by(b.c.id)
+            .limit(limit)
+        )
+        return [dict(row) for row in rows]
+
+    def iter_available(self, chunk_size) -> Iterator[Dict]:
+        """All batches, fetched `chunk_size` rows at a time."""
+        after = 0
+        while True:
+            rows = self.available(after, chunk_size)
+            yield from rows
+            if len(rows) < chunk_size:
+                return
+            after = rows[-1]['id']
+
+    def archive_exhausted(self, before, limit) -> int:
+        """
+        Moves up to `limit` batches with no available quantity whose ETA
+        is before `before` (or that are in stock already, with no ETA),
+        and their allocations, to the archive tables. Returns how many.
+        """
+        b = orm.batches
+        allocated = _allocated_qty()
+        ids = [row.id for row in self.session.execute(
+            select([b.c.id])
+            .select_from(b.outerjoin(allocated, allocated.c.batch_id == b.c.id))
+            .where(or_(b.c.eta < before, b.c.eta.is_(None)))
+            .where(b.c._qty - func.coalesce(allocated.c.qty, 0) <= 0)
+            .order_by(b.c.id)
+            .limit(limit)
+            .with_for_update(of=b)
+        )]
+        if not ids:
+            return 0
+        columns = ['id', 'ref', 'sku', '_qty', 'eta']
+        self.session.execute(orm.batches_archive.insert().from_select(
+            columns, select([b.c[c] for c in columns]).where(b.c.id.in_(ids))))
+        a = orm.allocations
+        columns = ['id', 'orderline_id', 'batch_id', 'created_at', 'expires_at']
+        self.session.execute(orm.allocations_archive.insert().from_select(
+            columns, select([a.c[c] for c in columns]).where(a.c.batch_id.in_(ids))))
+        self.session.execute(a.delete().where(a.c.batch_id.in_(ids)))
+        self.session.execute(b.delete().where(b.c.id.in_(ids)))
+        return len(ids)
 
+    def archived_refs_for_order(self, orderid) -> List[str]:
+        b, a, l = orm.batches_archive, orm.allocations_archive, orm.order_lines
+        return [row.ref for row in self.session.execute(
+            select([b.c.ref]).distinct()
+            .select_from(b.join(a, a.c.batch_id == b.c.id)
+                         .join(l, a.c.orderline_id == l.c.id))
+            .where(l.c.orderid == orderid)
+        )]
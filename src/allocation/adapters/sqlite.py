@@ -0,0 +1,65 @@
+"""
+Engines for running on a single node against a SQLite file instead of
+Postgres: config.get_db_uri() returns a sqlite:// URI.
+
+SQLite allows one writer at a time, and in WAL mode readers don't block
+it nor it them. So units of work that write get an engine with a single
+pooled connection whose transactions start with BEGIN IMMEDIATE, taking
+the write lock up front: a deferred transaction that read first could
+only fail, not wait, when upgrading to a write lock held by another.
+Read-only units of work get a pool of connections of their own.
+"""
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from allocation import config
+from allocation.adapters import orm
+
+
+def is_sqlite(uri) -> bool:
+    return make_url(uri).get_backend_name() == 'sqlite'
+
+
+def is_memory(uri) -> bool:
+    return make_url(uri).database in (None, '', ':memory:')
+
+
+def make_engine(uri, writer=True, pool_size=1):
+    if is_memory(uri):
+        # one connection, or each would have a database of its own
+        engine = create_engine(uri, poolclass=StaticPool,
+                               connect_args={'check_same_thread': False})
+    else:
+        # file databases aren't pooled by default in SQLAlchemy 1.3
+        engine = create_engine(
+            uri, poolclass=QueuePool,
+            pool_size=1 if writer else pool_size, max_overflow=0,
+            connect_args={'check_same_thread': False},
+        )
+    settings = config.get_sqlite_settings()
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        # pysqlite starts transactions itself, and only before writes;
+        # stop it, and start them in on_begin instead
+        # https://docs.sqlalchemy.org/en/13/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        # https://www.sqlite.org/pragma.html
+        cursor.execute('PRAGMA journal_mode=WAL')
+        # with WAL, only a checkpoint syncs: a power loss may lose the last
+        # transactions, but can't corrupt the database
+        cursor.execute(f"PRAGMA synchronous={settings['synchronous']}")
+        cursor.execute(f"PRAGMA cache_size=-{settings['cache_size']}")  # KiB
+        cursor.execute(f"PRAGMA busy_timeout={settings['busy_timeout']}")
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def on_begin(conn):
+        conn.execute('BEGIN IMMEDIATE' if writer else 'BEGIN')
+
+    if writer:
+        orm.metadata.create_all(engine)  # tables that don't exist yet
+    return engine
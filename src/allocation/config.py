@@ -1,14 +1,125 @@
 import os
 
-def get_postgres_uri():
-    host = os.environ.get('DB_HOST', 'localhost')
+def get_postgres_uri(host=None):
+    host = host or os.environ.get('DB_HOST', 'localhost')
     port = 5432
     password = os.environ.get('DB_PASSWORD', 'abc123')
     user, db_name = 'allocation', 'allocation'
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_db_uri():
+    # e.g. sqlite:////var/lib/allocation/allocation.db for a single node
+    return os.environ.get('DATABASE_URI') or get_postgres_uri()
+
+
+def get_sqlite_settings():
+    return dict(
+        busy_timeout=int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+        cache_size=int(os.environ.get('SQLITE_CACHE_SIZE_KB', 64 * 1024)),
+        synchronous=os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    )
+
+
+def get_replica_uri():
+    # a read replica for read-only units of work, None if there's none
+    host = os.environ.get('DB_REPLICA_HOST')
+    return get_postgres_uri(host) if host else None
+
+
+def get_replica_max_lag():
+    # seconds a replica may lag behind before reads go to the primary
+    return float(os.environ.get('DB_REPLICA_MAX_LAG', 5))
+
+
 def get_api_url():
     host = os.environ.get('API_HOST', 'localhost')
     port = 5005 if host == 'localhost' else 80
-    return f"http://{host}:{port}"
\ No newline at end of file
+    return f"http://{host}:{port}"
+
+
+def get_isolation_level():
+    # e.g. READ COMMITTED, REPEATABLE READ or SERIALIZABLE; None keeps
+    # the database default
+    return os.environ.get('DB_ISOLATION_LEVEL') or None
+
+
+def get_retry_policy():
+    return dict(
+        attempts=int(os.environ.get('RETRY_ATTEMPTS', 3)),
+        backoff=float(os.environ.get('RETRY_BACKOFF', 0.05)),
+        max_backoff=float(os.environ.get('RETRY_MAX_BACKOFF', 1.0)),
+    )
+
+
+def get_outbox_settings():
+    return dict(
+        path=os.environ.get('OUTBOX_FILE', 'outbox.jsonl'),
+        batch_size=int(os.environ.get('OUTBOX_BATCH_SIZE', 100)),
+        interval=float(os.environ.get('OUTBOX_POLL_INTERVAL', 1.0)),
+    )
+
+
+def get_command_log_path():
+    # where the API appends the commands it handles, None to not log them
+    return os.environ.get('COMMAND_LOG') or None
+
+
+def get_archive_chunk_size():
+    return int(os.environ.get('ARCHIVE_CHUNK_SIZE', 500))
+
+
+def get_expiry_settings():
+    # a ttl of 0 means allocations don't expire unless asked to
+    return dict(
+        ttl=float(os.environ.get('ALLOCATION_TTL', 0)),
+        interval=float(os.environ.get('EXPIRY_SWEEP_INTERVAL', 60)),
+        chunk_size=int(os.environ.get('EXPIRY_CHUNK_SIZE', 500)),
+    )
+
+
+def get_web_workers():
+    return int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1))
+
+
+def get_pool_settings(workers=1):
+    # Every worker process has its own pool, so the connections the
+    # database allows us are split between them
+    max_connections = int(os.environ.get('DB_MAX_CONNECTIONS', 20))
+    return dict(pool_size=max(1, max_connections // workers), max_overflow=0)
+
+
+def get_sku_catalogue_settings():
+    return dict(
+        error_rate=float(os.environ.get('SKU_CATALOGUE_ERROR_RATE', 0.01)),
+        # after a failed load, how long to let every SKU through
+        retry_interval=float(os.environ.get('SKU_CATALOGUE_RETRY', 5.0)),
+    )
+
+
+def get_coalescer_settings():
+    # a window of 0 disables coalescing of /allocate requests
+    return dict(
+        window=float(os.environ.get('ALLOCATE_COALESCE_WINDOW_MS', 0)) / 1000,
+        max_size=int(os.environ.get('ALLOCATE_COALESCE_MAX_SIZE', 64)),
+    )
+
+
+def get_batch_cache_settings():
+    # max_skus of 0 disables the cache
+    return dict(
+        max_skus=int(os.environ.get('BATCH_CACHE_SKUS', 1024)),
+        max_lines=int(os.environ.get('BATCH_CACHE_LINES', 100_000)),
+    )
+
+
+def get_admission_settings(workers=1):
+    # By default as many units of work run at once as each worker has
+    # pooled connections; more would only queue inside the pool
+    pool_size = get_pool_settings(workers)['pool_size']
+    return dict(
+        max_concurrent=int(os.environ.get('ADMISSION_MAX_CONCURRENT', 0)) or pool_size,
+        max_queue=int(os.environ.get('ADMISSION_MAX_QUEUE', 2 * pool_size)),
+        timeout=float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 1.0)),
+        retry_after=int(os.environ.get('ADMISSION_RETRY_AFTER', 1)),
+    )
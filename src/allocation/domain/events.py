@@ -0,0 +1,24 @@
+from dataclasses import dataclass
+
+
+# Events record something that happened in the domain, for
+# other systems to hear about. They are published from the
+# outbox after the transaction that raised them commits.
+class Event:
+    pass
+
+
+@dataclass
+class Allocated(Event):
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
+
+
+@dataclass
+class Deallocated(Event):
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
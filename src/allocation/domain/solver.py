@@ -0,0 +1,125 @@
+from __future__ import annotations
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from allocation.domain import model
+
+# A plan maps every OrderLine of the window to the ref of the Batch
+# it should be allocated to, or None if it can't be fulfilled.
+Plan = Dict[model.OrderLine, Optional[model.Ref]]
+
+
+def _capacities(lines: Sequence[model.OrderLine],
+                batches: Sequence[model.Batch]) -> List[int]:
+    """
+    Quantity each Batch could hold if the lines of the window that are
+    already allocated to it were released first.
+    """
+    window = set(lines)
+    return [
+        b.available_qty + sum(l.qty for l in b._allocations if l in window)
+        for b in batches
+    ]
+
+
+def _first_fit(lines: Sequence[model.OrderLine],
+               batches: Sequence[model.Batch],
+               capacities: List[int]) -> Plan:
+    plan: Plan = {}
+    capacities = list(capacities)
+    for line in lines:
+        plan[line] = None
+        for i, batch in enumerate(batches):
+            if batch.sku == line.sku and capacities[i] >= line.qty:
+                capacities[i] -= line.qty
+                plan[line] = batch.ref
+                break
+    return plan
+
+
+def _largest_first(lines: Sequence[model.OrderLine]) -> List[model.OrderLine]:
+    return sorted(lines, key=lambda l: l.qty, reverse=True)
+
+
+def _current(lines: Sequence[model.OrderLine],
+             batches: Sequence[model.Batch]) -> Dict[model.OrderLine, model.Ref]:
+    """The batch each line of the window is allocated to now, if any."""
+    window = set(lines)
+    return {line: b.ref for b in batches for line in b._allocations if line in window}
+
+
+def _score(plan: Plan, rank: Dict[model.Ref, int],
+           current: Dict[model.OrderLine, model.Ref]) -> Tuple[int, int, int]:
+    """
+    Higher is better: maximise the fulfilled quantity first, then
+    minimise the quantity-weighted ETA rank of the chosen batches, then
+    move as little of what's allocated already as possible.
+    """
+    fulfilled = sum(line.qty for line, ref in plan.items() if ref is not None)
+    lateness = sum(
+        line.qty * rank[ref] for line, ref in plan.items() if ref is not None
+    )
+    kept = sum(line.qty for line, ref in current.items() if plan[line] == ref)
+    return fulfilled, -lateness, kept
+
+
+def plan_allocations(lines: Sequence[model.OrderLine],
+                     batches: Sequence[model.Batch]) -> Plan:
+    """
+    Computes an assignment of a window of order lines to batches that
+    maximises the fulfilled quantity while preferring earlier ETAs.
+    Lines that are allocated already may move to another batch, but are
+    never left out, and stay put when moving them gains nothing.
+
+    Lines can't be split across batches, which makes the exact problem
+    a multiple knapsack. Instead, first-fit passes over the batches in
+    ETA order are compared: in arrival order (what repeated calls to
+    `allocate` would do) and largest line first, which packs big orders
+    before small ones fragment the early batches; each with every line
+    free to move, and with the allocated lines kept where they are. All
+    passes are O(lines x batches), and the winner is never worse than
+    the greedy arrival-order allocation.
+    """
+    ordered = sorted(batches)
+    capacities = _capacities(lines, ordered)
+    rank = {b.ref: i for i, b in enumerate(ordered)}
+    current = _current(lines, ordered)
+    kept = list(capacities)
+    for line, ref in current.items():
+        kept[rank[ref]] -= line.qty
+    pending = [line for line in lines if line not in current]
+
+    candidates = [
+        _first_fit(lines, ordered, capacities),
+        _first_fit(_largest_first(lines), ordered, capacities),
+        {**current, **_first_fit(pending, ordered, kept)},
+        {**current, **_first_fit(_largest_first(pending), ordered, kept)},
+    ]
+    # the last two always qualify
+    candidates = [
+        plan for plan in candidates
+        if all(plan[line] is not None for line in current)
+    ]
+    return max(candidates, key=lambda p: _score(p, rank, current))
+
+
+def allocate_window(lines: Sequence[model.OrderLine],
+                    batches: List[model.Batch]) -> Plan:
+    """
+    Domain Service to allocate a window of order lines against a list
+    of batches at once. Lines of the window that are already allocated
+    are released and re-planned together with the pending ones; other
+    allocations are left untouched.
+    """
+    assert len(batches) > 0, "At least 1 batch is needed"
+    plan = plan_allocations(lines, batches)
+    current = _current(lines, batches)
+    # release everything that moves first, so the capacity is there
+    # when the lines are allocated to their new batch
+    by_ref = {b.ref: b for b in batches}
+    for line, old in current.items():
+        if plan[line] != old:
+            by_ref[old].deallocate(line.orderid, line.sku, line.qty)
+    for line, new in plan.items():
+        if new is not None and current.get(line) != new:
+            by_ref[new].allocate(line)
+    return plan
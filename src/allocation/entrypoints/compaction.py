@@ -0,0 +1,20 @@
+import datetime
+
+from allocation import config
+from allocation.adapters import orm
+from allocation.service_layer import services, unit_of_work
+
+
+def main():
+    """Archives exhausted batches; meant to be run periodically, e.g. by cron."""
+    orm.start_mappers()
+    archived = services.archive_exhausted_batches(
+        datetime.date.today(),
+        unit_of_work.SQLAlchemyUnitOfWork(),
+        chunk_size=config.get_archive_chunk_size(),
+    )
+    print(f'archived {archived} batches')
+
+
+if __name__ == '__main__':
+    main()
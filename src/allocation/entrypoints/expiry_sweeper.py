@@ -0,0 +1,44 @@
+"""
+Releases expired allocations in the background, every
+EXPIRY_SWEEP_INTERVAL seconds, reporting the units freed by each run.
+
+    python -m allocation.entrypoints.expiry_sweeper [--once]
+"""
+import logging
+import sys
+import time
+from datetime import datetime
+
+from allocation import config, metrics
+from allocation.adapters import orm
+from allocation.service_layer import retry, services, unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+def sweep(uow, chunk_size):
+    try:
+        freed = retry.call(services.release_expired_allocations,
+                           datetime.utcnow(), uow, chunk_size=chunk_size)
+    except Exception:
+        # the database may be back by the next run
+        metrics.increment('expiry.errors')
+        logger.exception('expiry sweep failed')
+        return
+    print(f'released {freed} units', flush=True)
+
+
+def main():
+    logging.basicConfig()
+    orm.start_mappers()
+    settings = config.get_expiry_settings()
+    uow = unit_of_work.SQLAlchemyUnitOfWork()
+    while True:
+        sweep(uow, settings['chunk_size'])
+        if '--once' in sys.argv[1:]:  # e.g. from cron
+            return
+        time.sleep(settings['interval'])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,96 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
 import datetime
+import functools
+import json
+import time
 
+from allocation import config, metrics
 from allocation.domain import model
-from allocation.adapters import orm
-from allocation.service_layer import services, unit_of_work
+from allocation.adapters import command_log, orm
+from allocation.service_layer import (
+    admission, coalescer, retry, services, sku_catalogue, unit_of_work,
+)
 
 
 app = Flask(__name__)
 orm.start_mappers()
+# loaded on first use, from the primary, see SkuCatalogue
+skus = sku_catalogue.SkuCatalogue(
+    lambda: services.list_skus(unit_of_work.SQLAlchemyUnitOfWork(), primary=True),
+    lambda: services.skus_version(unit_of_work.SQLAlchemyUnitOfWork()),
+    **config.get_sku_catalogue_settings(),
+)
+# caps the requests using the database at once, see AdmissionController
+admissions = admission.AdmissionController(**config.get_admission_settings())
+# opt-in, when ALLOCATE_COALESCE_WINDOW_MS is set
+coalescing = config.get_coalescer_settings()
+allocations = coalescer.AllocationCoalescer(
+    unit_of_work.SQLAlchemyUnitOfWork, skus=skus, admissions=admissions,
+    **coalescing,
+) if coalescing['window'] > 0 else None
+# the default expiry, for allocations that don't say when they expire
+expiry = config.get_expiry_settings()
+# opt-in, when COMMAND_LOG is set, for replaying traffic later
+commands = command_log.CommandLog(
+    config.get_command_log_path()) if config.get_command_log_path() else None
 
+
+def admitted(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        admissions.acquire()
+        try:
+            response = view(*args, **kwargs)
+        except BaseException:
+            admissions.release()
+            raise
+        if isinstance(response, Response) and response.is_streamed:
+            # the unit of work is in use until the body has been sent
+            response.call_on_close(admissions.release)
+        else:
+            admissions.release()
+        return response
+    return wrapper
+
+
+def record(command, outcome):
+    if commands is not None:
+        # the arguments of a command are in its URL, or else its body
+        args = request.view_args or request.get_json(silent=True)
+        commands.record(g.arrived_at, command, args, outcome)
+
+
+def logged(command):
+    """
+    Notes when a request arrives, for record(), and records the command
+    as failed if its view raises, e.g. once retries run out.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            g.arrived_at = time.time()
+            try:
+                return view(*args, **kwargs)
+            except admission.Overloaded:
+                raise  # shed without being run
+            except Exception as exc:
+                record(command, command_log.error(exc))
+                raise
+        return wrapper
+    return decorator
+
+
+@app.errorhandler(admission.Overloaded)
+def overloaded(exc):
+    response = jsonify({'message': str(exc)})
+    response.headers['Retry-After'] = str(exc.retry_after)
+    return response, 503
+
+
+# admitted below: coalesced requests wait on their group, which is
+# admitted once, rather than each holding a slot
 @app.route("/allocate", methods=['POST'])
+@logged('allocate')
 def allocate_endpoint():
     uow = unit_of_work.SQLAlchemyUnitOfWork()
 
@@ -18,19 +99,34 @@ def allocate_endpoint():
         request.json['sku'],
         request.json['qty'],
     )
+    # seconds until the allocation is released unless confirmed, if ever
+    ttl = request.json.get('expires_in', expiry['ttl'])
+    if isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or ttl < 0:
+        return jsonify({'message': 'expires_in must be a number of seconds'}), 400
+    expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl) if ttl else None
     try:
-        batchref = services.allocate(oid, sku, qty, uow)
+        # coalesced allocations can't carry an expiry, those go on their own
+        if allocations is not None and expires_at is None:
+            batchref = allocations.submit(oid, sku, qty).result()
+        else:
+            with admissions.admit():
+                batchref = retry.call(services.allocate, oid, sku, qty, uow, skus=skus,
+                                      expires_at=expires_at)
     except (
         model.OutOfStock,
         model.UnallocatedSKU,
         services.InvalidSKU
     ) as exc:
+        record('allocate', command_log.error(exc))
         return jsonify({'message': str(exc)}), 400
 
+    record('allocate', batchref)
     return jsonify({'batchref': batchref}), 201
 
 
 @app.route("/add_batch", methods=['POST'])
+@logged('add_batch')
+@admitted
 def add_batch():
     uow = unit_of_work.SQLAlchemyUnitOfWork()
 
@@ -38,6 +134,90 @@ def add_batch():
     if eta is not None:
         eta = datetime.date.fromisoformat(eta)
     r, s, q = request.json['ref'], request.json['sku'], request.json['qty']
-    services.add_batch(r, s, q, eta, uow)
+    retry.call(services.add_batch, r, s, q, eta, uow, skus=skus)
+    record('add_batch', None)
+
+    return 'OK', 201
+
+
+@app.route("/batches", methods=['GET'])
+@admitted
+def list_batches():
+    uow = unit_of_work.SQLAlchemyUnitOfWork()
+
+    if request.args.get('format') == 'ndjson':
+        rows = services.stream_batches(uow)
+        return Response(
+            (json.dumps(row) + '\n' for row in rows),
+            mimetype='application/x-ndjson',
+        )
+
+    after = request.args.get('after', 0, type=int)
+    limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+    batches, cursor = services.list_batches(uow, after, limit)
+    return jsonify({'batches': batches, 'next': cursor}), 200
+
+
+def _batch_change(change) -> dict:
+    """A change from PATCH /batches, checked and parsed. Raises ValueError."""
+    if not isinstance(change, dict) or not isinstance(change.get('ref'), str) \
+            or not {'qty', 'eta'} & change.keys():
+        raise ValueError('Each change needs a ref and a qty or eta')
+    change = {k: change[k] for k in ('ref', 'qty', 'eta') if k in change}
+    qty = change.get('qty', 0)
+    if isinstance(qty, bool) or not isinstance(qty, int) or qty < 0:
+        raise ValueError('qty must be a whole number, 0 or more')
+    if change.get('eta') is not None:
+        try:
+            change['eta'] = datetime.date.fromisoformat(change['eta'])
+        except (TypeError, ValueError):
+            raise ValueError('eta must be an ISO date, or null')
+    return change
+
+
+@app.route("/batches", methods=['PATCH'])
+@logged('change_batches')
+@admitted
+def change_batches():
+    uow = unit_of_work.SQLAlchemyUnitOfWork()
+
+    body = request.get_json(silent=True)
+    batches = body.get('batches') if isinstance(body, dict) else None
+    if not isinstance(batches, list):
+        return jsonify({'message': 'batches must be a list of changes'}), 400
+    if len(batches) > 1000:
+        return jsonify({'message': 'At most 1000 changes at once'}), 400
+    try:
+        changes = [_batch_change(change) for change in batches]
+    except ValueError as exc:
+        return jsonify({'message': str(exc)}), 400
+    results = retry.call(services.change_batches, changes, uow)
+    record('change_batches', results)
+    return jsonify({'batches': results}), 200
+
+
+@app.route("/allocations/<orderid>", methods=['GET'])
+@admitted
+def allocations_endpoint(orderid):
+    uow = unit_of_work.SQLAlchemyUnitOfWork()
+    batchrefs = services.allocations_for_order(orderid, uow)
+    if not batchrefs:
+        return jsonify({'message': f'Unknown order: {orderid}'}), 404
+    return jsonify({'batchrefs': batchrefs}), 200
+
+
+@app.route("/allocations/<orderid>/confirm", methods=['POST'])
+@logged('confirm')
+@admitted
+def confirm_endpoint(orderid):
+    uow = unit_of_work.SQLAlchemyUnitOfWork()
+    confirmed = retry.call(services.confirm_allocations, orderid, uow)
+    record('confirm', confirmed)
+    if not confirmed:
+        return jsonify({'message': f'No allocations to confirm: {orderid}'}), 404
+    return jsonify({'confirmed': confirmed}), 200
+
 
-    return 'OK', 201
\ No newline at end of file
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    return jsonify(metrics.snapshot()), 200
@@ -0,0 +1,19 @@
+from allocation import config
+from allocation.adapters import orm, outbox
+from allocation.service_layer import outbox_relay, unit_of_work
+
+
+def main():
+    orm.start_mappers()
+    settings = config.get_outbox_settings()
+    relay = outbox_relay.OutboxRelay(
+        unit_of_work.SQLAlchemyUnitOfWork(),
+        outbox.FilePublisher(settings['path']),
+        batch_size=settings['batch_size'],
+        interval=settings['interval'],
+    )
+    relay.run()  # in the foreground, until the process is stopped
+
+
+if __name__ == '__main__':
+    main()
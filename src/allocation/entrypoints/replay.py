@@ -0,0 +1,153 @@
+"""
+Replays a command log recorded by the API (see adapters/command_log.py)
+through the service layer, against an in-memory sqlite database, and
+reports throughput, the outcomes of the allocations, and the commands
+whose outcome differs from the recorded one.
+
+    python -m allocation.entrypoints.replay commands.jsonl [--speed N]
+
+Commands are replayed in the order they arrived in, which isn't the
+order they were logged in. By default they're replayed as fast as
+possible; with --speed N, at N times the rate they arrived at. The database starts empty, so
+the log should too: allocations to batches added before recording began
+show up as differences.
+
+Allocations expire as they did in the API: `expires_in` seconds, or the
+--ttl default (ALLOCATION_TTL), after they arrived. They're released as
+soon as they're due, rather than at the sweeper's next run, so commands
+close to an expiry may still differ.
+"""
+import argparse
+import collections
+import datetime
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Counter, Iterable, List, Tuple
+
+from sqlalchemy.orm import sessionmaker
+
+from allocation import config
+from allocation.adapters import command_log, orm, sqlite
+from allocation.domain import model
+from allocation.service_layer import services, unit_of_work
+
+
+def _date(value):
+    return datetime.date.fromisoformat(value) if value is not None else None
+
+
+def _utc(at: float) -> datetime.datetime:
+    return datetime.datetime.utcfromtimestamp(at)
+
+
+def _expires_in(command: str, args: dict, ttl: float) -> float:
+    return args.get('expires_in', ttl) if command == 'allocate' else 0
+
+
+def apply(command: str, args: dict, uow, at: float = 0, ttl: float = 0):
+    """
+    Runs a logged command that arrived at `at`, returning its outcome as
+    the API logs it.
+    """
+    try:
+        if command == 'allocate':
+            expires_in = _expires_in(command, args, ttl)
+            expires_at = _utc(at) + datetime.timedelta(seconds=expires_in) if expires_in else None
+            return services.allocate(args['orderid'], args['sku'], args['qty'], uow,
+                                     expires_at=expires_at)
+        if command == 'add_batch':
+            services.add_batch(args['ref'], args['sku'], args['qty'], _date(args['eta']), uow)
+            return None
+        if command == 'change_batches':
+            changes = []
+            for change in args['batches']:
+                change = {k: change[k] for k in ('ref', 'qty', 'eta') if k in change}
+                if 'eta' in change:
+                    change['eta'] = _date(change['eta'])
+                changes.append(change)
+            return services.change_batches(changes, uow)
+        if command == 'confirm':
+            return services.confirm_allocations(args['orderid'], uow)
+    except (model.OutOfStock, model.UnallocatedSKU, services.InvalidSKU) as exc:
+        return command_log.error(exc)
+    raise ValueError(f'Unknown command: {command}')
+
+
+@dataclass
+class Report:
+    commands: Counter[str] = field(default_factory=collections.Counter)
+    allocations: Counter[str] = field(default_factory=collections.Counter)
+    differences: List[Tuple[dict, object]] = field(default_factory=list)
+    elapsed: float = 0.0
+    max_lag: float = 0.0  # how far behind schedule, with a speed
+
+    def print_summary(self, show=10):
+        total = sum(self.commands.values())
+        print(f'{total} commands in {self.elapsed:.2f}s: '
+              f'{total / self.elapsed if self.elapsed else 0:.1f} commands/s')
+        for command, count in self.commands.most_common():
+            print(f'  {command:<20}{count:>8}')
+        print('allocations:')
+        for outcome, count in self.allocations.most_common():
+            print(f'  {outcome:<20}{count:>8}')
+        if self.max_lag:
+            print(f'fell behind schedule by up to {self.max_lag:.3f}s')
+        print(f'{len(self.differences)} differences from the recorded outcomes')
+        for entry, outcome in self.differences[:show]:
+            print(f'  {entry["c"]} {json.dumps(entry["a"])}: '
+                  f'recorded {json.dumps(entry["o"])}, replayed {json.dumps(outcome)}')
+
+
+def replay(entries: Iterable[dict], uow, speed: float = 0,
+           clock: Callable[[], float] = time.monotonic,
+           sleep: Callable[[float], None] = time.sleep, ttl: float = 0) -> Report:
+    report = Report()
+    start = clock()
+    first = None
+    expiring = False  # no need to sweep until something can expire
+    for entry in sorted(entries, key=lambda e: e['t']):
+        if speed:
+            first = entry['t'] if first is None else first
+            due = start + (entry['t'] - first) / speed
+            wait = due - clock()
+            if wait > 0:
+                sleep(wait)
+            else:
+                report.max_lag = max(report.max_lag, -wait)
+        if expiring:
+            services.release_expired_allocations(_utc(entry['t']), uow)
+        expiring = expiring or bool(_expires_in(entry['c'], entry['a'], ttl))
+        try:
+            outcome = apply(entry['c'], entry['a'], uow, entry['t'], ttl)
+        except Exception as exc:  # logged like the API logs it
+            outcome = command_log.error(exc)
+        # compare as logged, i.e. after a round trip through JSON
+        outcome = json.loads(json.dumps(outcome, default=str))
+        report.commands[entry['c']] += 1
+        if entry['c'] == 'allocate':
+            report.allocations[
+                outcome['error'] if isinstance(outcome, dict) else 'allocated'] += 1
+        if outcome != entry['o']:
+            report.differences.append((entry, outcome))
+    report.elapsed = clock() - start
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('log')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='N times real time; 0, the default, for as fast as possible')
+    parser.add_argument('--ttl', type=float, default=config.get_expiry_settings()['ttl'],
+                        help='seconds until allocations expire by default, as recorded with')
+    args = parser.parse_args(argv)
+
+    orm.start_mappers()
+    engine = sqlite.make_engine('sqlite://')
+    uow = unit_of_work.SQLAlchemyUnitOfWork(sessionmaker(bind=engine))
+    replay(command_log.read(args.log), uow, args.speed, ttl=args.ttl).print_summary()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+Production server: a master process that pre-forks WEB_WORKERS workers
+serving the Flask app from one shared listening socket.
+
+The app, and so the mappers, are imported once in the master before
+forking. Each worker then builds its own engine, so no pooled connection
+is ever shared between processes.
+
+Signals to the master:
+    SIGHUP           graceful reload: start new workers, then let the old
+                     ones finish their in-flight requests and exit
+    SIGTERM, SIGINT  graceful shutdown
+
+A worker that fails logs why and exits non-zero; the master replaces it
+after a delay that doubles with each failure in a row, up to a minute.
+
+    python -m allocation.entrypoints.server
+"""
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+from allocation import config
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+class PreforkServer:
+    FIRST_BACKOFF = 0.1
+    MAX_BACKOFF = 60.0
+
+    def __init__(self, app, host='0.0.0.0', port=80, workers=None, admissions=None):
+        self.app = app
+        self.admissions = admissions
+        self.host, self.port = host, port
+        self.workers = workers or config.get_web_workers()
+        self.pids = set()
+        self.started = {}  # pid: when it was spawned
+        self.respawns = []  # when to replace each failed worker
+        self.failures = 0  # in a row
+        self.stopping = False
+        self.reloading = False
+
+    def listen(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(128)
+        self.sock.set_inheritable(True)
+
+    def run(self):
+        self.listen()
+        # no connection may be inherited by the workers
+        unit_of_work.DEFAULT_SESSION_FACTORY.kw['bind'].dispose()
+        unit_of_work.REPLICA_SESSION_FACTORY.kw['bind'].dispose()
+        signal.signal(signal.SIGHUP, lambda *_: setattr(self, 'reloading', True))
+        signal.signal(signal.SIGTERM, lambda *_: setattr(self, 'stopping', True))
+        signal.signal(signal.SIGINT, lambda *_: setattr(self, 'stopping', True))
+        for _ in range(self.workers):
+            self.spawn()
+        terminated = False
+        while self.pids or (self.respawns and not self.stopping):
+            if self.stopping and not terminated:
+                self.signal_workers(self.pids, signal.SIGTERM)
+                terminated = True
+            elif self.reloading and not self.stopping:
+                self.reload()
+            self.respawn_due()
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG) if self.pids else (0, 0)
+            except ChildProcessError:
+                break
+            if not pid:
+                time.sleep(0.1)
+            elif pid in self.pids:
+                self.pids.discard(pid)
+                if not self.stopping:
+                    self.replace(pid, os.waitstatus_to_exitcode(status))
+            self.started.pop(pid, None)
+        self.sock.close()
+
+    def replace(self, pid, code):
+        """
+        Replaces a dead worker: at once if it had been serving for a while,
+        later and later if workers keep failing, so that one that can't
+        start isn't forked again ten times a second.
+        """
+        lived = time.monotonic() - self.started.get(pid, 0)
+        if code == 0 or lived > self.MAX_BACKOFF:
+            self.failures = 0
+            delay = 0.0
+        else:
+            delay = self.backoff(self.failures)
+            self.failures += 1
+            logger.warning('worker %d exited with %d, replacing it in %.1fs',
+                           pid, code, delay)
+        self.respawns.append(time.monotonic() + delay)
+
+    def backoff(self, failures):
+        return min(self.FIRST_BACKOFF * 2 ** failures, self.MAX_BACKOFF)
+
+    def respawn_due(self):
+        now = time.monotonic()
+        due = [at for at in self.respawns if at <= now]
+        self.respawns = [at for at in self.respawns if at > now]
+        if not self.stopping:
+            for _ in due:
+                self.spawn()
+
+    def reload(self):
+        self.reloading = False
+        old = set(self.pids)
+        for _ in range(self.workers):
+            self.spawn()
+        self.pids -= old
+        for pid in old:
+            self.started.pop(pid, None)
+        self.signal_workers(old, signal.SIGTERM)
+
+    def signal_workers(self, pids, sig):
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.pids.add(pid)
+            self.started[pid] = time.monotonic()
+            return
+        code = 0
+        try:
+            self.serve()
+        except BaseException:
+            logger.exception('worker %d failed', os.getpid())
+            code = 1
+        finally:
+            # never return into the master's loop; _exit doesn't flush
+            sys.stderr.flush()
+            os._exit(code)
+
+    def serve(self):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        unit_of_work.rebuild_engine(self.workers)
+        if self.admissions is not None:
+            # admit no more than the worker's share of the connections
+            self.admissions.configure(**config.get_admission_settings(self.workers))
+        server = make_server(self.host, self.port, self.app,
+                             threaded=True, fd=self.sock.fileno())
+        server.daemon_threads = False  # so server_close() waits for requests
+        # shutdown() waits for serve_forever() to return, so it can't be
+        # called from the signal handler running on the same thread
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(
+            target=server.shutdown).start())
+        server.serve_forever()
+        server.server_close()
+
+
+def main():
+    logging.basicConfig()
+    # starts the mappers
+    from allocation.entrypoints.flask_app import admissions, app, skus
+    skus.refresh()  # once, the workers inherit it
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 80
+    PreforkServer(app, port=port, admissions=admissions).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+"""
+Process-wide counters and gauges, exposed by the API on GET /metrics.
+"""
+import threading
+from typing import Dict
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = {}  # counts, and sums of seconds
+_gauges: Dict[str, float] = {}
+
+
+def increment(name: str, amount: float = 1) -> None:
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def set_gauge(name: str, value: float) -> None:
+    with _lock:
+        _gauges[name] = value
+
+
+def snapshot() -> Dict[str, float]:
+    with _lock:
+        return {**_counters, **_gauges}
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
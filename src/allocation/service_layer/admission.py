@@ -0,0 +1,90 @@
+"""
+Admission control in front of the service layer.
+
+At most `max_concurrent` units of work run at once. Up to `max_queue`
+more requests wait, each for at most `timeout` seconds, for one of them
+to finish. Anything beyond that is shed straight away with Overloaded,
+so that when the database slows down, requests fail fast instead of all
+piling up on the connection pool and slowing down together.
+"""
+import contextlib
+import threading
+import time
+
+from allocation import metrics
+
+
+class Overloaded(Exception):
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+
+    def __init__(self, max_concurrent: int, max_queue: int = 0,
+                 timeout: float = 1.0, retry_after: int = 1):
+        self._running = 0
+        self._waiting = 0
+        self._cond = threading.Condition()
+        self.configure(max_concurrent, max_queue, timeout, retry_after)
+
+    def configure(self, max_concurrent: int, max_queue: int = 0,
+                  timeout: float = 1.0, retry_after: int = 1) -> None:
+        """Changes the limits, e.g. once a worker knows its pool size."""
+        with self._cond:
+            self.max_concurrent = max_concurrent
+            self.max_queue = max_queue
+            self.timeout = timeout
+            self.retry_after = retry_after
+            self._cond.notify_all()  # there may be room for more now
+
+    @contextlib.contextmanager
+    def admit(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self) -> None:
+        """
+        Takes a slot, waiting in the queue if need be. Raises Overloaded
+        if the queue is full, or if no slot frees up before the deadline.
+        """
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            if self._running < self.max_concurrent and not self._waiting:
+                self._admitted()
+                return
+            if self._waiting >= self.max_queue:
+                metrics.increment('admission.rejected')
+                raise Overloaded('Too many requests queued', self.retry_after)
+            self._waiting += 1
+            metrics.set_gauge('admission.queue_depth', self._waiting)
+            try:
+                while self._running >= self.max_concurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        metrics.increment('admission.timeouts')
+                        raise Overloaded('Timed out waiting to be admitted',
+                                         self.retry_after)
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+                metrics.set_gauge('admission.queue_depth', self._waiting)
+            self._admitted()
+            metrics.increment('admission.wait_seconds',
+                              time.monotonic() - deadline + self.timeout)
+
+    def release(self) -> None:
+        with self._cond:
+            self._running -= 1
+            metrics.set_gauge('admission.running', self._running)
+            self._cond.notify()
+
+    def _admitted(self):
+        self._running += 1
+        metrics.increment('admission.admitted')
+        metrics.set_gauge('admission.running', self._running)
@@ -0,0 +1,89 @@
+"""
+Coalesces concurrent allocations of the same SKU into one transaction.
+
+Requests for a SKU are gathered for up to `window` seconds, or until
+`max_size` of them are waiting, and then allocated in arrival order by
+services.allocate_in_order. Instead of each request opening its own unit
+of work and queueing for the SKU's row locks, a group takes them once.
+
+With an AdmissionController, a group takes one of its slots while it
+runs; the requests waiting on the group don't hold slots of their own.
+"""
+import contextlib
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+from allocation import metrics
+from allocation.domain import model
+from allocation.service_layer import retry, services
+from allocation.service_layer.admission import AdmissionController
+from allocation.service_layer.sku_catalogue import SkuCatalogue
+
+
+class _Group:
+
+    def __init__(self, sku):
+        self.sku = sku
+        self.requests: List[Tuple[model.OrderLine, Future]] = []
+
+
+class AllocationCoalescer:
+
+    def __init__(self, uow_factory: Callable, window: float = 0.005, max_size: int = 64,
+                 skus: Optional[SkuCatalogue] = None,
+                 admissions: Optional[AdmissionController] = None):
+        self.uow_factory = uow_factory
+        self.window = window
+        self.max_size = max_size
+        self.skus = skus
+        self.admissions = admissions
+        self._groups: Dict[str, _Group] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, orderid: model.OrderId, sku: model.Sku, qty: model.Qty) -> Future:
+        """
+        Queues an allocation. The future resolves to the ref of the batch
+        allocated to, or raises the error this line failed with.
+        """
+        future: Future = Future()
+        if self.skus is not None and not self.skus.might_contain(sku):
+            future.set_exception(services.InvalidSKU(f'Invalid SKU: {sku}'))
+            return future
+        with self._lock:
+            group = self._groups.get(sku)
+            if group is None:
+                group = self._groups[sku] = _Group(sku)
+                timer = threading.Timer(self.window, self._flush, [group])
+                timer.daemon = True
+                timer.start()
+            group.requests.append((model.OrderLine(orderid, sku, qty), future))
+            full = len(group.requests) >= self.max_size
+        if full:
+            self._flush(group)
+        return future
+
+    def _flush(self, group: _Group):
+        with self._lock:
+            if self._groups.get(group.sku) is not group:
+                return  # already flushed, by its timer or for being full
+            del self._groups[group.sku]
+        metrics.increment('coalescer.groups')
+        metrics.increment('coalescer.requests', len(group.requests))
+        lines = [line for line, _ in group.requests]
+        admit = self.admissions.admit() if self.admissions else contextlib.nullcontext()
+        try:
+            with admit:
+                results = retry.call(
+                    services.allocate_in_order, group.sku, lines, self.uow_factory())
+        except Exception as exc:  # Overloaded included
+            for _, future in group.requests:
+                future.set_exception(exc)
+            return
+        for (_, future), result in zip(group.requests, results):
+            if isinstance(result, Exception):
+                if isinstance(result, services.InvalidSKU) and self.skus is not None:
+                    self.skus.false_positive(group.sku)
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,56 @@
+"""
+Drains the outbox to a publisher in the background, so that downstream
+systems hear about allocations without adding their latency to requests.
+
+Delivery is at least once: messages are marked as published only after
+the publisher has accepted them, so a crash in between publishes them
+again. A single relay publishes in outbox order, which keeps the
+messages of each SKU in order.
+"""
+import threading
+from datetime import datetime
+
+from allocation import metrics
+from allocation.adapters import outbox
+
+
+def drain(uow, publisher: outbox.AbstractPublisher, batch_size: int = 100) -> int:
+    """Publishes the next batch of unpublished messages, returns how many."""
+    with uow:
+        messages = uow.outbox.unpublished(batch_size)
+        if messages:
+            publisher.publish(messages)
+            uow.outbox.mark_published([m['id'] for m in messages], datetime.utcnow())
+        pending, oldest = uow.outbox.pending()
+        uow.commit()
+    metrics.increment('outbox.published', len(messages))
+    metrics.set_gauge('outbox.pending', pending)
+    lag = (datetime.utcnow() - oldest).total_seconds() if oldest else 0.0
+    metrics.set_gauge('outbox.lag_seconds', lag)
+    return len(messages)
+
+
+class OutboxRelay(threading.Thread):
+
+    def __init__(self, uow, publisher, batch_size=100, interval=1.0):
+        super().__init__(daemon=True)
+        self.uow = uow
+        self.publisher = publisher
+        self.batch_size = batch_size
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                published = drain(self.uow, self.publisher, self.batch_size)
+            except Exception:
+                metrics.increment('outbox.errors')
+                published = 0
+            # keep draining while there's a backlog, poll otherwise
+            if published < self.batch_size:
+                self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
@@ -0,0 +1,86 @@
+"""
+Retries service functions whose transaction lost a serialization or
+deadlock conflict against a concurrent one, changed a Batch someone else
+changed since it was loaded (see orm.start_mappers), or, on sqlite,
+waited for the write lock for longer than its busy timeout. Each attempt runs the whole
+service function again, so the unit of work starts from a fresh session.
+"""
+import functools
+import random
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm.exc import StaleDataError
+
+from allocation import config, metrics
+
+# https://www.postgresql.org/docs/current/errcodes-appendix.html
+SERIALIZATION_FAILURE = '40001'
+DEADLOCK_DETECTED = '40P01'
+RETRYABLE_PGCODES = {SERIALIZATION_FAILURE, DEADLOCK_DETECTED}
+# https://www.sqlite.org/rescode.html#busy
+SQLITE_BUSY = 'database is locked'
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    attempts: int = 3  # the first one included
+    backoff: float = 0.05
+    max_backoff: float = 1.0
+
+    def __post_init__(self):
+        # with none, call() would return None without calling anything
+        if self.attempts < 1:
+            raise ValueError(f'attempts must be at least 1, not {self.attempts}')
+
+    @classmethod
+    def from_config(cls) -> 'RetryPolicy':
+        return cls(**config.get_retry_policy())
+
+    def delay(self, attempt: int) -> float:
+        # exponential backoff with full jitter, so that the transactions
+        # that just conflicted don't retry in lockstep
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+def is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, StaleDataError):
+        return True
+    if not isinstance(exc, DBAPIError):
+        return False
+    if isinstance(exc.orig, sqlite3.OperationalError):
+        return str(exc.orig) == SQLITE_BUSY
+    return getattr(exc.orig, 'pgcode', None) in RETRYABLE_PGCODES
+
+
+def call(fn, *args, policy: Optional[RetryPolicy] = None, **kwargs):
+    """
+    Calls a service function, retrying it with backoff when it fails on
+    a retryable conflict. Other exceptions propagate straight away.
+    """
+    policy = policy or RetryPolicy.from_config()
+    for attempt in range(policy.attempts):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as exc:
+            if not is_retryable(exc):
+                raise
+            if attempt == policy.attempts - 1:
+                metrics.increment('retry.exhausted')
+                raise
+            metrics.increment('retry.retries')
+            time.sleep(policy.delay(attempt))
+
+
+def retrying(fn=None, *, policy: Optional[RetryPolicy] = None):
+    """Decorator version of `call`."""
+    if fn is None:
+        return functools.partial(retrying, policy=policy)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return call(fn, *args, policy=policy, **kwargs)
+    return wrapper
@@ -1,6 +1,9 @@
+from allocation import metrics
 from allocation.service_layer import unit_of_work
-from allocation.domain import model
-from typing import List, Optional
+from allocation.service_layer.sku_catalogue import SkuCatalogue
+from allocation.domain import events, model, solver
+from datetime import date, datetime
+from typing import Iterator, List, Optional, Tuple, Union
 
 
 class InvalidSKU(Exception):
@@ -14,26 +17,226 @@ def is_valid_sku(sku: str, batches: List[model.Batch]) -> bool:
     skus = {b.sku for b in batches}
     return sku in skus
 
-def add_batch(ref: str, sku: str, qty: int, eta: Optional[str], uow):
+def _no_batches(sku: str, uow) -> Exception:
+    """
+    The error for a SKU without batches: out of stock if it had some that
+    were archived once used up, invalid otherwise.
+    """
+    if uow.batches.has_archived(sku):
+        return model.OutOfStock(f'Out of stock for {sku}')
+    return InvalidSKU(f'Invalid SKU: {sku}')
+
+def list_skus(uow, primary: bool = False) -> List[str]:
+    with (uow if primary else uow.for_reading()) as reader:
+        return reader.batches.skus()
+
+def skus_version(uow):
+    """Changes whenever a SKU may have been added, see SkuCatalogue."""
+    with uow:
+        return uow.batches.skus_version()
+
+def add_batch(ref: str, sku: str, qty: int, eta: Optional[str], uow,
+              skus: Optional[SkuCatalogue] = None):
     batch = model.Batch(ref, sku, qty, eta)
     with uow:
         uow.batches.add(batch)
         uow.commit()
+    if skus is not None:
+        skus.add(sku)
 
-def allocate(orderid:str, sku: str, qty: int, uow) -> str:
+def allocate(orderid:str, sku: str, qty: int, uow, fast_path: bool = True,
+             skus: Optional[SkuCatalogue] = None,
+             expires_at: Optional[datetime] = None) -> str:
     """
     Obtains a list of Batches from data layer, validates OrderLine,
     calls the allocate domain service, and commits to database.
+
+    With fast_path, the common case where the first batch in ETA order
+    has enough stock is handled by a single conditional UPDATE instead,
+    falling back to the domain model for everything else. With a SKU
+    catalogue, unknown SKUs are rejected without opening the uow. With
+    expires_at, the allocation is released then by the expiry sweeper.
     """
+    if skus is not None and not skus.might_contain(sku):
+        raise InvalidSKU(f'Invalid SKU: {sku}')
+    try:
+        return _allocate(orderid, sku, qty, uow, fast_path, expires_at)
+    except InvalidSKU:
+        if skus is not None:
+            skus.false_positive(sku)
+        raise
+
+def _allocate(orderid, sku, qty, uow, fast_path, expires_at=None):
     with uow:
-        batches = uow.batches.list()
-        if not is_valid_sku(sku, batches):
-            raise InvalidSKU(f'Invalid SKU: {sku}')
-        ref = model.allocate(orderid, sku, qty, batches)
+        ref = None
+        # allocating a line again changes nothing, its expiry included
+        if expires_at is not None and uow.batches.is_allocated(
+                model.OrderLine(orderid, sku, qty)):
+            expires_at = None
+        if fast_path:
+            ref = uow.batches.allocate_fast(model.OrderLine(orderid, sku, qty))
+            metrics.increment('allocate.fast_path' if ref else 'allocate.fallback')
+        if ref is None:
+            uow.lock_batches(sku)
+            batches = uow.batches.list_for_sku(sku)
+            if not is_valid_sku(sku, batches):
+                raise _no_batches(sku, uow)
+            ref = model.allocate(orderid, sku, qty, batches)
+        if expires_at is not None:
+            uow.batches.set_expiry(model.OrderLine(orderid, sku, qty), expires_at)
+        uow.outbox.add(events.Allocated(orderid, sku, qty, ref))
         uow.commit()
     return ref
 
 
+def allocate_in_order(sku: str, lines: List[model.OrderLine], uow) -> List[Union[str, Exception]]:
+    """
+    Allocates OrderLines of one SKU one after the other, in the order
+    given, in a single transaction. Returns, for each line, the ref it
+    was allocated to or the domain error that prevented it.
+    """
+    results: List[Union[str, Exception]] = []
+    with uow:
+        uow.lock_batches(sku)
+        batches = uow.batches.list_for_sku(sku)
+        for line in lines:
+            if not batches:
+                results.append(_no_batches(line.sku, uow))
+                continue
+            try:
+                ref = model.allocate(line.orderid, line.sku, line.qty, batches)
+            except model.OutOfStock as exc:
+                results.append(exc)
+                continue
+            uow.outbox.add(events.Allocated(line.orderid, line.sku, line.qty, ref))
+            results.append(ref)
+        uow.commit()
+    return results
+
+
+def allocate_window(sku: str, lines: List[model.OrderLine], uow) -> List[Optional[model.Ref]]:
+    """
+    Allocates a window of pending OrderLines of one SKU together, so that
+    a large order isn't left out of stock by earlier small ones. Returns,
+    for each line in the order given, the ref it was allocated to, or
+    None if it couldn't be.
+    """
+    with uow:
+        uow.lock_batches(sku)
+        batches = uow.batches.list_for_sku(sku)
+        if not batches:
+            raise _no_batches(sku, uow)
+        window = set(lines)
+        before = {line: b.ref for b in batches for line in b._allocations if line in window}
+        plan = solver.allocate_window(lines, batches)
+        # by position: an order's lines may be equal, and once committed
+        # the lines are expired, so they're no use as keys to the caller
+        refs = [plan[line] for line in lines]
+        # only the lines that moved, as if they'd been deallocated and
+        # allocated again: every release first, so that downstream never
+        # sees a batch allocated beyond its quantity
+        moved = [line for line in lines if plan[line] != before.get(line)]
+        for line in moved:
+            if line in before:
+                uow.outbox.add(events.Deallocated(line.orderid, line.sku, line.qty, before[line]))
+        for line in moved:
+            ref = plan[line]
+            if ref is not None:
+                uow.outbox.add(events.Allocated(line.orderid, line.sku, line.qty, ref))
+        uow.commit()
+    return refs
+
+
+def archive_exhausted_batches(today: date, uow, chunk_size: int = 500) -> int:
+    """
+    Moves batches that are fully consumed and past their ETA to the
+    archive, one transaction per chunk so locks are held briefly.
+    Returns how many batches were archived.
+    """
+    archived = 0
+    while True:
+        with uow:
+            moved = uow.batches.archive_exhausted(today, chunk_size)
+            uow.commit()
+        archived += moved
+        if moved < chunk_size:
+            return archived
+
+
+def confirm_allocations(orderid: str, uow) -> int:
+    """
+    Confirms an order, so its allocations don't expire. Returns how many
+    allocations were still due to expire.
+    """
+    with uow:
+        confirmed = uow.batches.confirm(orderid)
+        uow.commit()
+    return confirmed
+
+
+def release_expired_allocations(now: datetime, uow, chunk_size: int = 500) -> int:
+    """
+    Releases the allocations that expired by `now`, one transaction per
+    chunk, telling downstream systems through the outbox. Returns how
+    many units of stock were freed.
+    """
+    freed = 0
+    while True:
+        with uow:
+            released = uow.batches.release_expired(now, chunk_size)
+            for line, ref in released:
+                uow.outbox.add(events.Deallocated(line.orderid, line.sku, line.qty, ref))
+            uow.commit()
+        units = sum(line.qty for line, _ in released)
+        metrics.increment('expiry.released', len(released))
+        metrics.increment('expiry.units_freed', units)
+        freed += units
+        if len(released) < chunk_size:
+            return freed
+
+
+def allocations_for_order(orderid: str, uow) -> List[str]:
+    """
+    Refs of the batches an order is allocated to, archived ones included.
+    """
+    with uow.for_reading() as reader:
+        refs = [b.ref for b in reader.batches.list_for_order(orderid)]
+        return refs + reader.batches.archived_refs_for_order(orderid)
+
+
+def _batch_view(row: dict) -> dict:
+    eta = row['eta']
+    return dict(
+        ref=row['ref'],
+        sku=row['sku'],
+        eta=eta.isoformat() if eta is not None else None,
+        available_qty=row['available_qty'],
+    )
+
+
+def list_batches(uow, after: int = 0, limit: int = 100) -> Tuple[List[dict], Optional[int]]:
+    """
+    A page of batches with their available quantities, and the cursor to
+    pass as `after` for the next page (None on the last one).
+    """
+    if limit < 1:
+        raise ValueError(f'limit must be at least 1, not {limit}')
+    with uow.for_reading() as reader:
+        rows = reader.batches.available(after, limit)
+    cursor = rows[-1]['id'] if len(rows) == limit else None
+    return [_batch_view(r) for r in rows], cursor
+
+
+def stream_batches(uow, chunk_size: int = 500) -> Iterator[dict]:
+    """
+    All batches with their available quantities, read in chunks so that
+    memory use doesn't grow with the number of batches.
+    """
+    with uow.for_reading() as reader:
+        for row in reader.batches.iter_available(chunk_size):
+            yield _batch_view(row)
+
+
 def deallocate(orderid:str, sku: str, qty: int, ref: str, uow):
     with uow:
         batch: model.Batch = uow.batches.get(ref)
@@ -51,8 +254,49 @@ def reallocate(line: model.OrderLine, uow: unit_of_work.AbstractUnitOfWork) -> s
 
 def change_batch_quantity(batchref, new_qty, uow):
     with uow:
-        batch = uow.batches.get(ref=batchref)
-        batch.change_purchased_quantity(new_qty)
-        while batch.available_qty < 0:
-            batch.deallocate_one()
-        uow.commit()
\ No newline at end of file
+        batch = uow.batches.get(batchref)
+        _change_quantity(batch, new_qty, uow)
+        uow.commit()
+
+def _change_quantity(batch: model.Batch, new_qty: int, uow) -> List[model.OrderLine]:
+    """
+    Deallocates lines until the batch isn't overallocated any more,
+    telling downstream systems through the outbox.
+    """
+    batch.change_purchased_quantity(new_qty)
+    deallocated = []
+    while batch.available_qty < 0:
+        line = batch.deallocate_one()
+        uow.outbox.add(events.Deallocated(line.orderid, line.sku, line.qty, batch.ref))
+        deallocated.append(line)
+    return deallocated
+
+def change_batches(changes: List[dict], uow) -> List[dict]:
+    """
+    Applies many changes to batches in one transaction, loading all the
+    batches concerned in a single query. Each change has the 'ref' of a
+    batch and its new 'qty', its new 'eta', or both. Returns the outcome
+    of each change: the batch's new available quantity and the orders
+    deallocated from it, or that there is no such batch.
+    """
+    with uow:
+        batches = {b.ref: b for b in uow.batches.get_many({c['ref'] for c in changes})}
+        results = []
+        for change in changes:
+            batch = batches.get(change['ref'])
+            if batch is None:
+                results.append(dict(ref=change['ref'], status='not_found'))
+                continue
+            if 'eta' in change:
+                batch.eta = change['eta']
+            deallocated = []
+            if 'qty' in change:
+                deallocated = _change_quantity(batch, change['qty'], uow)
+            results.append(dict(
+                ref=batch.ref,
+                status='updated',
+                available_qty=batch.available_qty,
+                deallocated=[line.orderid for line in deallocated],
+            ))
+        uow.commit()
+    return results
\ No newline at end of file
@@ -0,0 +1,105 @@
+"""
+In-memory membership test for the SKUs we stock, so that requests for
+unknown SKUs can be rejected with one cheap query instead of a whole
+allocation.
+
+A Bloom filter answers "definitely not stocked" or "maybe stocked" in a
+few bytes per SKU. Maybes fall through to the database as before, and
+the few that turn out not to be stocked are counted as false positives.
+"""
+import hashlib
+import math
+import threading
+import time
+from typing import Callable, Hashable, Iterable, Optional
+
+from allocation import metrics
+
+
+class BloomFilter:
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        # double hashing: h1 + i * h2 stands in for `hashes` hash functions
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key: str) -> None:
+        for p in self._positions(key):
+            self.bits[p // 8] |= 1 << (p % 8)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[p // 8] & (1 << (p % 8)) for p in self._positions(key))
+
+
+class SkuCatalogue:
+    """
+    The SKUs we stock, loaded with `load` when first used. Other processes
+    add SKUs too, which this one's filter doesn't see. So a miss is only
+    final if `version`, which changes whenever a SKU may have been added
+    anywhere, still returns what it did before the last load; otherwise
+    the catalogue is reloaded and asked again. Both must read the primary
+    database, where a SKU is added first.
+    """
+
+    def __init__(self, load: Callable[[], Iterable[str]],
+                 version: Callable[[], Hashable], error_rate: float = 0.01,
+                 retry_interval: float = 5.0):
+        self.load = load
+        self.version = version
+        self.error_rate = error_rate
+        self.retry_interval = retry_interval
+        self._filter: Optional[BloomFilter] = None
+        self._version: Hashable = None
+        self._failed_at = -math.inf
+        self._lock = threading.Lock()
+        # held while loading, so that concurrent misses load once
+        self._refreshing = threading.Lock()
+
+    def refresh(self) -> None:
+        # read first: a SKU added during the load changes it again
+        try:
+            version = self.version()
+            skus = list(self.load())
+        except Exception:
+            # so that every miss doesn't retry a failing load
+            self._failed_at = time.monotonic()
+            raise
+        # room to grow before the false positive rate degrades
+        bloom = BloomFilter(max(2 * len(skus), 1024), self.error_rate)
+        for sku in skus:
+            bloom.add(sku)
+        with self._lock:
+            self._filter, self._version = bloom, version
+
+    def add(self, sku: str) -> None:
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(sku)
+
+    def might_contain(self, sku: str) -> bool:
+        if self._filter is not None and sku in self._filter:
+            return True
+        if time.monotonic() - self._failed_at < self.retry_interval:
+            return True  # can't tell, let the database decide
+        try:
+            if self._filter is None or self.version() != self._version:
+                with self._refreshing:
+                    # unless another thread reloaded while we waited
+                    if self._filter is None or self.version() != self._version:
+                        self.refresh()
+        except Exception:
+            return True  # likewise
+        if self._filter is None or sku in self._filter:
+            return True
+        metrics.increment('skus.rejected')
+        return False
+
+    def false_positive(self, sku: str) -> None:
+        metrics.increment('skus.false_positives')
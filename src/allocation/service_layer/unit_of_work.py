@@ -1,17 +1,85 @@
 from __future__ import annotations
 import abc
+import time
 from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import sessionmaker
 
-from allocation import config
-from allocation.adapters import repository
+from allocation import config, metrics
+from allocation.adapters import batch_cache, outbox, repository, sqlite
+
+def make_engine(workers=1, uri=None):
+    uri = uri or config.get_db_uri()
+    if sqlite.is_sqlite(uri):
+        return sqlite.make_engine(uri)
+    return create_engine(
+        uri,
+        isolation_level=config.get_isolation_level(),
+        **config.get_pool_settings(workers),
+    )
+
+
+def make_replica_engine(workers=1):
+    uri = config.get_replica_uri()
+    if uri:
+        return make_engine(workers, uri)
+    uri = config.get_db_uri()
+    if sqlite.is_sqlite(uri) and not sqlite.is_memory(uri):
+        # readers of the same file, that don't queue behind the writer
+        return sqlite.make_engine(
+            uri, writer=False, pool_size=config.get_pool_settings(workers)['pool_size'])
+    return None
+
+
+DEFAULT_SESSION_FACTORY = sessionmaker(bind=make_engine())
+# Read-only units of work use the replica, or the primary if there's none
+REPLICA_SESSION_FACTORY = sessionmaker(
+    bind=make_replica_engine() or DEFAULT_SESSION_FACTORY.kw['bind'])
+
+
+# Hydrated Batches shared by the units of work on the default database
+DEFAULT_BATCH_CACHE = batch_cache.BatchCache(
+    **config.get_batch_cache_settings()
+) if config.get_batch_cache_settings()['max_skus'] else None
+
+
+def rebuild_engine(workers=1):
+    """
+    Binds the default session factories to new engines, and so to new
+    connection pools. Called in each worker process after a fork, since
+    pooled connections must never be shared between processes.
+    """
+    primary = make_engine(workers)
+    DEFAULT_SESSION_FACTORY.configure(bind=primary)
+    REPLICA_SESSION_FACTORY.configure(bind=make_replica_engine(workers) or primary)
+
+
+def replica_lag(session) -> float:
+    """Seconds the database behind a session lags behind its primary."""
+    connection = session.connection()
+    if connection.dialect.name != 'postgresql':
+        return 0.0
+    # PostgreSQL 10 renamed the xlog functions to wal ones
+    # https://www.postgresql.org/docs/10/release-10.html
+    if connection.dialect.server_version_info >= (10,):
+        received, replayed = 'pg_last_wal_receive_lsn', 'pg_last_wal_replay_lsn'
+    else:
+        received, replayed = 'pg_last_xlog_receive_location', 'pg_last_xlog_replay_location'
+    # 0 when everything received has been replayed, and on a primary
+    return connection.execute(
+        f'SELECT CASE WHEN {received}() = {replayed}()'
+        ' THEN 0 ELSE COALESCE(EXTRACT(EPOCH FROM'
+        ' now() - pg_last_xact_replay_timestamp()), 0) END'
+    ).scalar()
+
+
+class ReadOnly(Exception):
+    pass
 
-DEFAULT_SESSION_FACTORY = sessionmaker(bind=create_engine(
-    config.get_postgres_uri(),
-))
 
 class AbstractUnitOfWork(abc.ABC):
     batches: repository.AbstractRepository
+    outbox: outbox.AbstractOutbox
 
     def __enter__(self) -> AbstractUnitOfWork:
         return self
@@ -19,6 +87,20 @@ class AbstractUnitOfWork(abc.ABC):
     def __exit__(self, *args):
         self.rollback()
 
+    def for_reading(self) -> AbstractUnitOfWork:
+        """
+        A unit of work for read-only service functions, which may read
+        from a replica. Just this one unless overridden.
+        """
+        return self
+
+    def lock_batches(self, sku):
+        """
+        Locks the Batches of a SKU until the unit of work commits or rolls
+        back, so concurrent allocations of that SKU are serialised instead
+        of losing each other's updates. A no-op unless overridden.
+        """
+
     @abc.abstractmethod
     def commit(self):
         raise NotImplementedError
@@ -30,20 +112,82 @@ class AbstractUnitOfWork(abc.ABC):
 
 
 class SQLAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY,
+                 replica_session_factory=None, cache=None):
         self.session_factory = session_factory
+        # a unit of work on another database reads from that database too,
+        # and doesn't share the default cache, unless told otherwise
+        if session_factory is DEFAULT_SESSION_FACTORY:
+            replica_session_factory = replica_session_factory or REPLICA_SESSION_FACTORY
+            cache = cache or DEFAULT_BATCH_CACHE
+        self.replica_session_factory = replica_session_factory or session_factory
+        self.cache = cache
 
     def __enter__(self):
         self.session = self.session_factory()
-        self.batches = repository.SQLAlchemyRepository(self.session)
+        self.batches = repository.SQLAlchemyRepository(self.session, self.cache)
+        self.outbox = outbox.SQLAlchemyOutbox(self.session)
         return super().__enter__()
 
     def __exit__(self, *args):
         super().__exit__(*args)
         self.session.close()
 
+    def for_reading(self):
+        return ReadOnlyUnitOfWork(self.replica_session_factory, self.session_factory)
+
+    def lock_batches(self, sku):
+        start = time.monotonic()
+        self.batches.lock(sku)
+        metrics.increment('uow.locks')  # taken, waited for or not
+        metrics.increment('uow.lock_wait_seconds', time.monotonic() - start)
+
     def commit(self):
         self.session.commit()
+        if self.cache is not None:
+            for sku in self.session.info.pop('written_skus', ()):
+                self.cache.invalidate(sku)
 
     def rollback(self):
         self.session.rollback()
+        self.session.info.pop('written_skus', None)
+
+
+class ReadOnlyUnitOfWork(SQLAlchemyUnitOfWork):
+    """
+    Reads from a replica, or from the primary instead when the replica
+    lags behind by more than `max_lag` seconds or can't be reached.
+    """
+    def __init__(self, replica_session_factory, primary_session_factory,
+                 max_lag=None, lag=replica_lag):
+        super().__init__(replica_session_factory, replica_session_factory)
+        self.primary_session_factory = primary_session_factory
+        self.max_lag = config.get_replica_max_lag() if max_lag is None else max_lag
+        self.lag = lag
+
+    def __enter__(self):
+        super().__enter__()
+        if self._on_replica():
+            try:
+                stale = self.lag(self.session) > self.max_lag
+            except DBAPIError:
+                # unreachable, or rejecting the query: either way this
+                # session's transaction is done for
+                stale = True
+            if stale:
+                metrics.increment('uow.replica_fallbacks')
+                self.session.close()
+                self.session = self.primary_session_factory()
+                self.batches = repository.SQLAlchemyRepository(self.session)
+                self.outbox = outbox.SQLAlchemyOutbox(self.session)
+        return self
+
+    def _on_replica(self):
+        return self.session_factory.kw.get('bind') is not \
+            self.primary_session_factory.kw.get('bind')
+
+    def for_reading(self):
+        return self
+
+    def commit(self):
+        raise ReadOnly('Read-only unit of work')
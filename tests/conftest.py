@@ -42,6 +42,13 @@ def session_factory(in_memory_db):
     # As such, it is only for usage in test suites that re-use the same classes with
     # different mappings, which is itself an extremely rare use case
 
+@pytest.fixture
+def second_session_factory(session_factory):
+    # another in-memory database, e.g. standing in for a replica
+    engine = create_engine('sqlite:///:memory:')
+    orm.metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
 @pytest.fixture
 def session(session_factory):
     return session_factory()
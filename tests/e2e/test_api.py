@@ -60,4 +60,18 @@ def test_unhappy_path_returns_400_and_error_message():
     url = config.get_api_url()
     r = requests.post(f'{url}/allocate', json=data)
     assert r.status_code == 400
-    assert r.json()['message'] == f'Invalid SKU: {unknown_sku}'
\ No newline at end of file
+    assert r.json()['message'] == f'Invalid SKU: {unknown_sku}'
+
+
+@pytest.mark.usefixtures('postgres_db')
+@pytest.mark.usefixtures('restart_api')
+@pytest.mark.parametrize('body', [
+    {},
+    {'batches': [{'ref': 'b1', 'qty': -1}]},
+    {'batches': [{'ref': 'b1', 'qty': '5'}]},
+    {'batches': [{'ref': 'b1', 'eta': 'bad'}]},
+])
+def test_invalid_batch_changes_return_400(body):
+    url = config.get_api_url()
+    r = requests.patch(f'{url}/batches', json=body)
+    assert r.status_code == 400
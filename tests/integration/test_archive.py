@@ -0,0 +1,84 @@
+from datetime import date, timedelta
+
+import pytest
+
+from allocation.domain import model
+
+from allocation.service_layer import services, unit_of_work
+
+SKU = "KETTLE"
+today = date.today()
+yesterday = today - timedelta(days=1)
+tomorrow = today + timedelta(days=1)
+
+
+def count(session, table):
+    [[n]] = session.execute(f'SELECT count(*) FROM {table}')
+    return n
+
+
+def test_archives_only_exhausted_batches_past_their_eta(session_factory):
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    services.add_batch('past-used', SKU, 10, yesterday, uow)
+    services.allocate('o1', SKU, 10, uow)
+    services.add_batch('past-free', SKU, 10, yesterday, uow)
+    services.add_batch('future', SKU, 10, tomorrow, uow)
+    services.allocate('o2', SKU, 10, uow)
+    services.allocate('o3', SKU, 10, uow)
+
+    archived = services.archive_exhausted_batches(today, uow)
+
+    assert archived == 2  # past-used and past-free, future isn't due yet
+    session = session_factory()
+    refs = {ref for [ref] in session.execute('SELECT ref FROM batches')}
+    assert refs == {'future'}
+    assert count(session, 'batches_archive') == 2
+    assert count(session, 'allocations_archive') == 2
+    assert count(session, 'allocations') == 1
+
+
+def test_archives_in_chunks(session_factory):
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    for i in range(5):
+        services.add_batch(f'b{i}', SKU, 1, yesterday, uow)
+        services.allocate(f'o{i}', SKU, 1, uow)
+
+    assert services.archive_exhausted_batches(today, uow, chunk_size=2) == 5
+    assert count(session_factory(), 'batches') == 0
+
+
+def test_archived_allocations_still_resolve(session_factory):
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    services.add_batch('old', SKU, 5, yesterday, uow)
+    services.add_batch('new', SKU, 5, None, uow)
+    services.allocate('o1', SKU, 5, uow)
+    services.allocate('o1', SKU, 3, uow)
+    services.archive_exhausted_batches(today, uow)
+
+    assert sorted(services.allocations_for_order('o1', uow)) == ['new', 'old']
+    assert services.allocations_for_order('unknown', uow) == []
+
+
+def test_archived_ids_are_not_reused(session_factory):
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', SKU, 1, yesterday, uow)
+    services.allocate('o1', SKU, 1, uow)
+    assert services.archive_exhausted_batches(today, uow) == 1
+
+    services.add_batch('b2', SKU, 1, yesterday, uow)
+    services.allocate('o2', SKU, 1, uow)
+    assert services.archive_exhausted_batches(today, uow) == 1
+    assert count(session_factory(), 'batches_archive') == 2
+
+
+def test_a_sku_whose_batches_are_all_archived_is_out_of_stock(session_factory):
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', SKU, 1, yesterday, uow)
+    services.allocate('o1', SKU, 1, uow)
+    services.archive_exhausted_batches(today, uow)
+
+    with pytest.raises(model.OutOfStock):
+        services.allocate('o2', SKU, 1, uow)
+    with pytest.raises(services.InvalidSKU):
+        services.allocate('o2', 'NOPE', 1, uow)
+    assert services.list_skus(uow) == [SKU]
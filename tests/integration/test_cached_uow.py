@@ -0,0 +1,79 @@
+import pytest
+from sqlalchemy import event
+
+from allocation import metrics
+from allocation.adapters import batch_cache
+from allocation.service_layer import services, unit_of_work
+
+SKU = "VASE"
+
+
+@pytest.fixture
+def cached_uow(session_factory):
+    metrics.reset()
+    return unit_of_work.SQLAlchemyUnitOfWork(
+        session_factory, cache=batch_cache.BatchCache())
+
+
+@pytest.fixture
+def statements(in_memory_db):
+    executed = []
+    event.listen(in_memory_db, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args: executed.append(statement))
+    return executed
+
+
+def available(uow):
+    with uow:
+        return {b.ref: b.available_qty for b in uow.batches.list_for_sku(SKU)}
+
+
+def test_reuses_batches_across_units_of_work(cached_uow, statements):
+    services.add_batch('b1', SKU, 10, None, cached_uow)
+    services.allocate('o1', SKU, 3, cached_uow, fast_path=False)
+
+    assert available(cached_uow) == {'b1': 7}
+    statements.clear()
+    assert available(cached_uow) == {'b1': 7}
+
+    assert metrics.snapshot()['batch_cache.hits'] == 1
+    assert len(statements) == 1  # just the version check
+
+
+def test_commit_invalidates_the_sku(cached_uow):
+    services.add_batch('b1', SKU, 10, None, cached_uow)
+    available(cached_uow)
+    services.allocate('o1', SKU, 3, cached_uow, fast_path=False)
+    services.allocate('o2', SKU, 3, cached_uow, fast_path=False)
+
+    assert available(cached_uow) == {'b1': 4}
+
+
+def test_changes_made_outside_the_orm_are_noticed(cached_uow):
+    services.add_batch('b1', SKU, 10, None, cached_uow)
+    available(cached_uow)
+    services.allocate('o1', SKU, 3, cached_uow, fast_path=True)
+
+    assert metrics.snapshot()['allocate.fast_path'] == 1
+    assert available(cached_uow) == {'b1': 7}
+    assert 'batch_cache.hits' not in metrics.snapshot()
+
+
+def test_allocations_through_cached_batches_are_saved(cached_uow, session_factory):
+    services.add_batch('b1', SKU, 10, None, cached_uow)
+    services.add_batch('b2', SKU, 10, None, cached_uow)
+    for i in range(4):
+        available(cached_uow)  # warm the cache
+        services.allocate(f'o{i}', SKU, 4, cached_uow, fast_path=False)
+
+    uncached = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    assert available(uncached) == {'b1': 2, 'b2': 2}
+    assert sorted(services.allocations_for_order('o3', uncached)) == ['b2']
+
+
+def test_unknown_skus_are_not_cached(cached_uow):
+    with cached_uow:
+        for i in range(3):
+            assert cached_uow.batches.list_for_sku(f'UNKNOWN-{i}') == []
+
+    assert cached_uow.cache._entries == {}
@@ -0,0 +1,37 @@
+import multiprocessing
+
+from sqlalchemy.orm import sessionmaker
+
+from allocation.adapters import sqlite
+from allocation.service_layer import services, sku_catalogue, unit_of_work
+
+
+def catalogue(uow):
+    return sku_catalogue.SkuCatalogue(
+        lambda: services.list_skus(uow, primary=True),
+        lambda: services.skus_version(uow),
+    )
+
+
+def add_batch_in_another_process(uri, ref, sku):
+    # like a prefork worker: its own engine, and a catalogue of its own
+    uow = unit_of_work.SQLAlchemyUnitOfWork(sessionmaker(bind=sqlite.make_engine(uri)))
+    services.add_batch(ref, sku, 10, None, uow, skus=catalogue(uow))
+
+
+def test_skus_added_by_other_processes_are_never_rejected(tmp_path, session_factory):
+    uri = f"sqlite:///{tmp_path / 'allocation.db'}"
+    uow = unit_of_work.SQLAlchemyUnitOfWork(sessionmaker(bind=sqlite.make_engine(uri)))
+    services.add_batch('b1', 'LAMP', 10, None, uow)
+    skus = catalogue(uow)
+    skus.refresh()
+
+    for i in range(3):
+        worker = multiprocessing.get_context('fork').Process(
+            target=add_batch_in_another_process, args=(uri, f'b{i + 2}', f'NEW-{i}'))
+        worker.start()
+        worker.join()
+        assert worker.exitcode == 0
+        assert skus.might_contain(f'NEW-{i}')
+        assert services.allocate(f'o{i}', f'NEW-{i}', 1, uow, skus=skus) == f'b{i + 2}'
+    assert not skus.might_contain('NOPE')
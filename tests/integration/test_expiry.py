@@ -0,0 +1,87 @@
+import json
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+
+from allocation import metrics
+from allocation.adapters import orm
+from allocation.entrypoints import expiry_sweeper
+from allocation.service_layer import services, unit_of_work
+
+SKU = "TEAPOT"
+now = datetime(2030, 1, 1, 12, 0)
+earlier, later = now - timedelta(minutes=5), now + timedelta(minutes=5)
+
+
+def available(session, ref):
+    [[qty, version]] = session.execute(
+        'SELECT available_qty, version FROM batches WHERE ref=:ref', dict(ref=ref))
+    return qty, version
+
+
+def test_allocations_record_when_they_were_made(session_factory):
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', SKU, 10, None, uow)
+    services.allocate('o1', SKU, 2, uow, fast_path=False)
+    services.allocate('o2', SKU, 2, uow, expires_at=later)
+
+    a = orm.allocations
+    rows = session_factory().execute(
+        select([a.c.created_at, a.c.expires_at]).order_by(a.c.id)).fetchall()
+    assert all(created_at is not None for created_at, _ in rows)
+    assert [expires_at for _, expires_at in rows] == [None, later]
+
+
+def test_releases_expired_allocations_and_frees_their_stock(session_factory):
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', SKU, 10, None, uow)
+    services.add_batch('b2', SKU, 10, later.date(), uow)
+    services.allocate('o1', SKU, 6, uow, expires_at=earlier)
+    services.allocate('o2', SKU, 3, uow, expires_at=later)
+    services.allocate('o3', SKU, 4, uow, expires_at=earlier, fast_path=False)
+    services.allocate('o4', SKU, 1, uow)
+    session = session_factory()
+    _, version = available(session, 'b1')
+
+    assert services.release_expired_allocations(now, uow, chunk_size=1) == 6 + 4
+
+    assert available(session, 'b1') == (10 - 3 - 1, version + 1)
+    assert available(session, 'b2')[0] == 10
+    assert sorted(services.allocations_for_order('o2', uow)) == ['b1']
+    assert services.allocations_for_order('o1', uow) == []
+    [[payload]] = session.execute("SELECT payload FROM outbox WHERE type='Deallocated'"
+                                  " AND payload LIKE '%o3%'")
+    assert json.loads(payload) == dict(orderid='o3', sku=SKU, qty=4, batchref='b2')
+    # the domain model agrees with the persisted available_qty
+    with uow:
+        [b1] = [b for b in uow.batches.list_for_sku(SKU) if b.ref == 'b1']
+        assert b1.available_qty == 6
+
+
+def test_confirmed_allocations_are_not_released(session_factory):
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', SKU, 10, None, uow)
+    services.allocate('o1', SKU, 2, uow, expires_at=earlier)
+    services.allocate('o2', SKU, 3, uow, expires_at=earlier)
+
+    assert services.confirm_allocations('o1', uow) == 1
+    assert services.confirm_allocations('o1', uow) == 0
+    # allocating the confirmed line again doesn't make it expire
+    services.allocate('o1', SKU, 2, uow, expires_at=earlier)
+
+    assert services.release_expired_allocations(now, uow) == 3
+    assert services.allocations_for_order('o1', uow) == ['b1']
+
+
+def test_a_failed_sweep_is_reported_and_not_fatal(session_factory, capsys):
+    class BrokenUnitOfWork(unit_of_work.SQLAlchemyUnitOfWork):
+        def __enter__(self):
+            raise OperationalError('SELECT', {}, Exception('connection refused'))
+
+    metrics.reset()
+    expiry_sweeper.sweep(BrokenUnitOfWork(session_factory), chunk_size=10)
+    expiry_sweeper.sweep(unit_of_work.SQLAlchemyUnitOfWork(session_factory), chunk_size=10)
+
+    assert metrics.snapshot()['expiry.errors'] == 1
+    assert capsys.readouterr().out == 'released 0 units\n'
@@ -0,0 +1,87 @@
+import random
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
+
+from allocation import metrics
+from allocation.adapters import orm
+from allocation.domain import model
+from allocation.service_layer import retry, services, unit_of_work
+
+SKU, OTHER_SKU = "TEAPOT", "CUP"
+today = date.today()
+
+
+def run(session_factory, fast_path, seed):
+    rng = random.Random(seed)
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    for i, eta in enumerate([None, today, today + timedelta(days=3), None]):
+        services.add_batch(f'b{i}', rng.choice([SKU, OTHER_SKU]), rng.randint(5, 40), eta, uow)
+    outcomes = []
+    for i in range(60):
+        orderid = f'o{rng.randint(0, 40)}'  # some repeated lines
+        sku = rng.choice([SKU, OTHER_SKU, 'NOPE'])
+        try:
+            outcomes.append(services.allocate(orderid, sku, rng.randint(1, 8), uow, fast_path))
+        except (model.OutOfStock, services.InvalidSKU) as exc:
+            outcomes.append(type(exc).__name__)
+    return outcomes, services.list_batches(uow, limit=10)[0]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_fast_path_agrees_with_the_domain_model(session_factory, second_session_factory, seed):
+    metrics.reset()
+    assert run(session_factory, True, seed) == run(second_session_factory, False, seed)
+    assert metrics.snapshot()['allocate.fast_path'] > 0
+
+
+def test_available_qty_is_persisted_through_the_domain_model(session_factory):
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', SKU, 10, None, uow)
+    services.allocate('o1', SKU, 3, uow, fast_path=False)
+
+    [[available]] = session_factory().execute('SELECT available_qty FROM batches')
+    assert available == 7
+
+
+def test_falls_back_when_available_qty_is_unknown(session_factory):
+    session = session_factory()
+    session.execute(
+        "INSERT INTO batches (ref, sku, _qty, eta) VALUES ('b1', :sku, 10, null)",
+        dict(sku=SKU),
+    )
+    session.commit()
+    metrics.reset()
+
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    assert services.allocate('o1', SKU, 3, uow) == 'b1'
+    assert metrics.snapshot()['allocate.fallback'] == 1
+    assert services.allocate('o2', SKU, 3, uow) == 'b1'
+    assert metrics.snapshot()['allocate.fast_path'] == 1
+
+
+def test_a_stale_writer_fails_instead_of_overwriting_an_allocation(tmp_path, session_factory):
+    # a file, so that the two sessions have connections of their own
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+    orm.metadata.create_all(engine)
+    sessions = sessionmaker(bind=engine)
+    uow = unit_of_work.SQLAlchemyUnitOfWork(sessions)
+    services.add_batch('b1', SKU, 10, None, uow)
+
+    stale = sessions()
+    batch = stale.query(model.Batch).one()
+    services.allocate('o1', SKU, 8, uow)  # the fast path, behind its back
+    batch.change_purchased_quantity(12)
+    with pytest.raises(StaleDataError) as exc:
+        stale.commit()
+    assert retry.is_retryable(exc.value)
+    stale.close()
+
+    retry.call(services.change_batch_quantity, 'b1', 12, uow)
+    [[available]] = sessions().execute('SELECT available_qty FROM batches')
+    assert available == 4
+    with pytest.raises(model.OutOfStock):
+        services.allocate('o2', SKU, 12, uow)
@@ -0,0 +1,46 @@
+import pytest
+
+from allocation.service_layer import services, unit_of_work
+
+SKU = "MIRROR"
+
+
+def add_batches(uow, n):
+    for i in range(n):
+        services.add_batch(f'b{i:02}', SKU, 10, None, uow)
+
+
+def test_pages_through_batches_with_available_quantities(session_factory):
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    add_batches(uow, 5)
+    services.allocate('o1', SKU, 3, uow)
+
+    page, cursor = services.list_batches(uow, limit=2)
+    assert page == [
+        dict(ref='b00', sku=SKU, eta=None, available_qty=7),
+        dict(ref='b01', sku=SKU, eta=None, available_qty=10),
+    ]
+    refs = [b['ref'] for b in page]
+    while cursor is not None:
+        page, cursor = services.list_batches(uow, after=cursor, limit=2)
+        refs += [b['ref'] for b in page]
+    assert refs == [f'b{i:02}' for i in range(5)]
+
+
+def test_streams_all_batches_in_chunks(session_factory):
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    add_batches(uow, 7)
+
+    rows = list(services.stream_batches(uow, chunk_size=3))
+    assert [r['ref'] for r in rows] == [f'b{i:02}' for i in range(7)]
+    assert {r['available_qty'] for r in rows} == {10}
+
+
+def test_limit_must_be_positive(session_factory):
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    add_batches(uow, 2)
+
+    with pytest.raises(ValueError):
+        services.list_batches(uow, limit=0)
+    assert services.list_batches(uow, limit=1) == (
+        [dict(ref='b00', sku=SKU, eta=None, available_qty=10)], 1)
@@ -0,0 +1,70 @@
+import pytest
+
+from allocation import metrics
+from allocation.adapters import outbox
+from allocation.domain import model
+from allocation.service_layer import outbox_relay, services, unit_of_work
+
+SKU, OTHER_SKU = "LAMP", "RUG"
+
+
+class BrokenPublisher(outbox.AbstractPublisher):
+
+    def publish(self, messages):
+        raise ConnectionError('warehouse is down')
+
+
+def allocate_some(uow):
+    services.add_batch('b1', SKU, 100, None, uow)
+    services.add_batch('b2', OTHER_SKU, 100, None, uow)
+    services.allocate('o1', SKU, 1, uow)
+    services.allocate('o2', OTHER_SKU, 2, uow)
+    services.allocate('o3', SKU, 3, uow)
+
+
+def test_relay_publishes_allocations_once_in_order(session_factory):
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    allocate_some(uow)
+    publisher = outbox.QueuePublisher()
+
+    assert outbox_relay.drain(uow, publisher, batch_size=2) == 2
+    assert outbox_relay.drain(uow, publisher, batch_size=2) == 1
+    assert outbox_relay.drain(uow, publisher, batch_size=2) == 0
+
+    messages = list(publisher.queue.queue)
+    assert [m['payload']['orderid'] for m in messages if m['sku'] == SKU] == ['o1', 'o3']
+    assert messages[0]['type'] == 'Allocated'
+    assert messages[0]['payload'] == dict(orderid='o1', sku=SKU, qty=1, batchref='b1')
+
+
+def test_outbox_rolls_back_with_the_allocation(session_factory):
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', SKU, 1, None, uow)
+    with pytest.raises(model.OutOfStock):
+        services.allocate('o1', SKU, 10, uow)
+
+    assert outbox_relay.drain(uow, outbox.QueuePublisher()) == 0
+
+
+def test_failed_publish_is_delivered_again(session_factory):
+    metrics.reset()
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    allocate_some(uow)
+
+    with pytest.raises(ConnectionError):
+        outbox_relay.drain(uow, BrokenPublisher())
+
+    publisher = outbox.QueuePublisher()
+    assert outbox_relay.drain(uow, publisher) == 3
+    assert metrics.snapshot()['outbox.pending'] == 0
+
+
+def test_lag_is_reported_for_pending_messages(session_factory):
+    metrics.reset()
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    allocate_some(uow)
+
+    outbox_relay.drain(uow, outbox.QueuePublisher(), batch_size=1)
+
+    assert metrics.snapshot()['outbox.pending'] == 2
+    assert metrics.snapshot()['outbox.lag_seconds'] >= 0
@@ -0,0 +1,102 @@
+from allocation.adapters import command_log
+from allocation.entrypoints import replay
+from allocation.service_layer import unit_of_work
+
+
+def write_log(path, entries):
+    log = command_log.CommandLog(str(path))
+    for entry in entries:
+        log.record(*entry)
+    log.close()
+    return list(command_log.read(str(path)))
+
+
+def test_replays_a_log_and_reports_differences(tmp_path, session_factory):
+    entries = write_log(tmp_path / 'commands.jsonl', [
+        (100.0, 'add_batch', dict(ref='b1', sku='LAMP', qty=10, eta=None), None),
+        (100.5, 'allocate', dict(orderid='o1', sku='LAMP', qty=8), 'b1'),
+        (101.0, 'allocate', dict(orderid='o2', sku='LAMP', qty=8), {'error': 'OutOfStock'}),
+        (101.5, 'allocate', dict(orderid='o3', sku='LAMP', qty=1), 'b2'),
+        (102.0, 'change_batches', dict(batches=[{'ref': 'b1', 'eta': '2030-01-01'}]),
+         [dict(ref='b1', status='updated', available_qty=1, deallocated=[])]),
+    ])
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+
+    report = replay.replay(entries, uow)
+
+    assert report.commands == {'add_batch': 1, 'allocate': 3, 'change_batches': 1}
+    assert report.allocations == {'allocated': 2, 'OutOfStock': 1}
+    [(entry, outcome)] = report.differences
+    assert entry['a']['orderid'] == 'o3' and outcome == 'b1'
+
+
+def test_replays_at_a_multiple_of_real_time(session_factory):
+    entries = [
+        dict(t=10.0, c='add_batch', a=dict(ref='b1', sku='LAMP', qty=10, eta=None), o=None),
+        dict(t=14.0, c='allocate', a=dict(orderid='o1', sku='LAMP', qty=1), o='b1'),
+    ]
+    now, sleeps = [0.0], []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    report = replay.replay(entries, unit_of_work.SQLAlchemyUnitOfWork(session_factory),
+                           speed=2, clock=lambda: now[0], sleep=sleep)
+
+    assert sleeps == [2.0]
+    assert not report.differences
+
+
+def test_logs_when_commands_arrived_and_completed(tmp_path):
+    [entry] = write_log(tmp_path / 'commands.jsonl', [
+        (100.0, 'confirm', dict(orderid='o1'), 0, 100.25),
+    ])
+    assert (entry['t'], entry['d']) == (100.0, 100.25)
+
+
+def test_replays_in_arrival_order(session_factory):
+    # logged as they completed: the allocation arrived after the batch
+    entries = [
+        dict(t=14.0, c='allocate', a=dict(orderid='o1', sku='LAMP', qty=1), o='b1'),
+        dict(t=10.0, c='add_batch', a=dict(ref='b1', sku='LAMP', qty=10, eta=None), o=None),
+    ]
+    now, sleeps = [0.0], []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    report = replay.replay(entries, unit_of_work.SQLAlchemyUnitOfWork(session_factory),
+                           speed=2, clock=lambda: now[0], sleep=sleep)
+
+    assert sleeps == [2.0]
+    assert report.max_lag == 0
+    assert not report.differences
+
+
+def test_failures_are_replayed_like_the_api_logs_them(session_factory):
+    entries = [
+        dict(t=10.0, c='allocate', a=dict(orderid='o1', sku='LAMP'), o={'error': 'KeyError'}),
+    ]
+    report = replay.replay(entries, unit_of_work.SQLAlchemyUnitOfWork(session_factory))
+
+    assert report.allocations == {'KeyError': 1}
+    assert not report.differences
+
+
+def test_allocations_expire_as_they_did_when_recorded(session_factory):
+    lamp = dict(sku='LAMP', qty=10)
+    entries = [
+        dict(t=100.0, c='add_batch', a=dict(ref='b1', eta=None, **lamp), o=None),
+        dict(t=101.0, c='allocate', a=dict(orderid='o1', expires_in=5, **lamp), o='b1'),
+        dict(t=102.0, c='confirm', a=dict(orderid='o1'), o=1),
+        dict(t=103.0, c='allocate', a=dict(orderid='o2', **lamp), o={'error': 'OutOfStock'}),
+        dict(t=110.0, c='add_batch', a=dict(ref='b2', eta=None, **lamp), o=None),
+        dict(t=111.0, c='allocate', a=dict(orderid='o3', **lamp), o='b2'),
+        dict(t=117.0, c='allocate', a=dict(orderid='o4', **lamp), o='b2'),
+    ]
+
+    report = replay.replay(entries, unit_of_work.SQLAlchemyUnitOfWork(session_factory), ttl=5)
+
+    assert not report.differences
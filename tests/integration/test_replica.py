@@ -0,0 +1,100 @@
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from allocation import metrics
+from allocation.service_layer import services, unit_of_work
+
+SKU = "LADDER"
+
+
+@pytest.fixture
+def replica_session_factory(second_session_factory):
+    return second_session_factory
+
+
+def add_batches(session_factory, *refs):
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    for ref in refs:
+        services.add_batch(ref, SKU, 10, None, uow)
+
+
+def listed_refs(uow):
+    return [b['ref'] for b in services.list_batches(uow)[0]]
+
+
+def test_read_only_services_read_from_the_replica(session_factory, replica_session_factory):
+    add_batches(session_factory, 'on-primary')
+    add_batches(replica_session_factory, 'on-replica')
+
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory, replica_session_factory)
+    assert listed_refs(uow) == ['on-replica']
+
+
+def test_writes_go_to_the_primary(session_factory, replica_session_factory):
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory, replica_session_factory)
+    services.add_batch('b1', SKU, 10, None, uow)
+
+    assert listed_refs(unit_of_work.SQLAlchemyUnitOfWork(session_factory)) == ['b1']
+    assert listed_refs(uow) == []
+
+
+def test_stale_replica_falls_back_to_the_primary(session_factory, replica_session_factory):
+    metrics.reset()
+    add_batches(session_factory, 'on-primary')
+    uow = unit_of_work.ReadOnlyUnitOfWork(
+        replica_session_factory, session_factory, max_lag=1, lag=lambda session: 30)
+
+    assert listed_refs(uow) == ['on-primary']
+    assert metrics.snapshot()['uow.replica_fallbacks'] == 1
+
+
+def test_unreachable_replica_falls_back_to_the_primary(session_factory, replica_session_factory):
+    def unreachable(session):
+        raise OperationalError('SELECT 1', {}, Exception('connection refused'))
+
+    add_batches(session_factory, 'on-primary')
+    uow = unit_of_work.ReadOnlyUnitOfWork(
+        replica_session_factory, session_factory, max_lag=1, lag=unreachable)
+
+    assert listed_refs(uow) == ['on-primary']
+
+
+def test_replica_that_cant_report_its_lag_falls_back_to_the_primary(
+        session_factory, replica_session_factory):
+    def unsupported(session):
+        raise ProgrammingError('SELECT pg_last_wal_receive_lsn()', {},
+                               Exception('function does not exist'))
+
+    add_batches(session_factory, 'on-primary')
+    uow = unit_of_work.ReadOnlyUnitOfWork(
+        replica_session_factory, session_factory, max_lag=1, lag=unsupported)
+
+    assert listed_refs(uow) == ['on-primary']
+
+
+@pytest.mark.parametrize('version, function', [
+    ((9, 6, 24), 'pg_last_xlog_receive_location'),
+    ((13, 4), 'pg_last_wal_receive_lsn'),
+])
+def test_replica_lag_uses_the_servers_function_names(version, function):
+    executed = []
+
+    class Connection:
+        dialect = SimpleNamespace(name='postgresql', server_version_info=version)
+
+        def execute(self, statement):
+            executed.append(statement)
+            return SimpleNamespace(scalar=lambda: 0)
+
+    session = SimpleNamespace(connection=Connection)
+    assert unit_of_work.replica_lag(session) == 0
+    assert f'{function}()' in executed[0]
+
+
+def test_read_only_unit_of_work_cant_commit(session_factory, replica_session_factory):
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory, replica_session_factory)
+    with pytest.raises(unit_of_work.ReadOnly):
+        with uow.for_reading() as reader:
+            reader.commit()
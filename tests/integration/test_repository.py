@@ -1,3 +1,5 @@
+from sqlalchemy import event
+
 from allocation.adapters import repository
 from allocation.domain import model
 
@@ -100,3 +102,49 @@ def test_updating_a_batch(session):
     session.commit()
 
     assert get_allocations(session, BATCH_1) == {ORDER_1, 'order2'}
+
+def test_repository_lists_batches_by_sku_and_by_order(session):
+    repo = repository.SQLAlchemyRepository(session)
+    sofa = model.Batch(BATCH_1, SOFA, HUNDRED, eta=None)
+    bench = model.Batch(BATCH_2, BENCH, HUNDRED, eta=None)
+    sofa.allocate(model.OrderLine(ORDER_1, SOFA, TWELVE))
+    repo.add(sofa)
+    repo.add(bench)
+    session.commit()
+
+    assert repo.list_for_sku(SOFA) == [sofa]
+    assert repo.list_for_sku(BENCH) == [bench]
+    assert repo.list_for_order(ORDER_1) == [sofa]
+    assert repo.list_for_order('order2') == []
+
+def test_repository_gets_many_batches_in_one_go(session):
+    repo = repository.SQLAlchemyRepository(session)
+    sofa = model.Batch(BATCH_1, SOFA, HUNDRED, eta=None)
+    bench = model.Batch(BATCH_2, BENCH, HUNDRED, eta=None)
+    sofa.allocate(model.OrderLine(ORDER_1, SOFA, TWELVE))
+    repo.add(sofa)
+    repo.add(bench)
+    session.commit()
+
+    assert repo.get_many([BATCH_2, BATCH_1, 'nope']) == [sofa, bench]
+    assert repo.get_many([]) == []
+
+def test_fast_path_queries_use_indexes(session, in_memory_db):
+    executed = []
+    event.listen(in_memory_db, 'before_cursor_execute',
+                 lambda conn, cursor, statement, params, *args:
+                 executed.append((statement, params)))
+    repo = repository.SQLAlchemyRepository(session)
+    repo.add(model.Batch(BATCH_1, SOFA, HUNDRED, eta=None))
+    session.flush()
+    executed.clear()
+
+    repo.allocate_fast(model.OrderLine(ORDER_1, SOFA, TWELVE))
+
+    cursor = session.connection().connection.cursor()
+    for statement, params in executed:
+        plan = cursor.execute(f'EXPLAIN QUERY PLAN {statement}', params).fetchall()
+        # SCAN CONSTANT ROW is the SELECT EXISTS itself, not a table
+        scans = [step for *_, step in plan
+                 if step.startswith('SCAN') and step != 'SCAN CONSTANT ROW']
+        assert not scans, statement
@@ -0,0 +1,51 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from allocation.service_layer import retry, services, unit_of_work
+
+
+@pytest.fixture
+def sqlite_uri(tmp_path, monkeypatch):
+    uri = f"sqlite:///{tmp_path / 'allocation.db'}"
+    monkeypatch.setenv('DATABASE_URI', uri)
+    monkeypatch.setenv('SQLITE_BUSY_TIMEOUT_MS', '50')
+    return uri
+
+
+def test_engine_is_tuned_and_creates_the_schema(sqlite_uri):
+    engine = unit_of_work.make_engine()
+
+    with engine.connect() as conn:
+        assert conn.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert conn.execute('PRAGMA synchronous').scalar() == 1  # NORMAL
+        assert conn.execute('PRAGMA busy_timeout').scalar() == 50
+    assert 'batches' in engine.table_names()
+    assert engine.pool.size() == 1
+
+
+def test_readers_get_a_pool_of_their_own(sqlite_uri):
+    reader = unit_of_work.make_replica_engine(workers=2)
+    assert reader.url == unit_of_work.make_engine().url
+    assert reader.pool.size() > 1
+
+
+def test_a_second_writer_waits_then_fails_retryably(sqlite_uri):
+    engine = unit_of_work.make_engine()
+    other = unit_of_work.make_engine()
+
+    with engine.begin():  # BEGIN IMMEDIATE: holds the write lock
+        with pytest.raises(OperationalError) as exc:
+            with other.begin():
+                pass
+    assert retry.is_retryable(exc.value)
+
+
+def test_reads_go_on_while_a_write_is_in_progress(sqlite_uri, session_factory):
+    writer = sessionmaker(bind=unit_of_work.make_engine())
+    reader = sessionmaker(bind=unit_of_work.make_replica_engine())
+    uow = unit_of_work.SQLAlchemyUnitOfWork(writer, reader)
+    services.add_batch('b1', 'LAMP', 10, None, uow)
+
+    with writer.kw['bind'].begin():
+        assert services.list_skus(uow) == ['LAMP']
@@ -1,4 +1,5 @@
-from allocation.service_layer import unit_of_work
+from allocation import metrics
+from allocation.service_layer import services, unit_of_work
 from allocation.domain import model
 import pytest
 
@@ -60,3 +61,52 @@ def test_rolls_back_on_error(session_factory):
     new_session = session_factory()
     rows = list(new_session.execute('SELECT * FROM "batches"'))
     assert rows == []
+
+def test_allocate_window_writes_back_through_the_uow(session_factory):
+    session = session_factory()
+    insert_batch(session, 'late', REAL_SKU, 10, '2011-01-02')
+    session.commit()
+
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    services.allocate(ORDER1, REAL_SKU, 5, uow)
+    insert_batch(session, 'early', REAL_SKU, 10, '2011-01-01')
+    session.commit()
+    services.allocate(ORDER2, REAL_SKU, 5, uow)
+    lines = [
+        model.OrderLine(ORDER1, REAL_SKU, 5),
+        model.OrderLine(ORDER2, REAL_SKU, 5),
+        model.OrderLine('order3', REAL_SKU, 10),
+    ]
+    refs = services.allocate_window(REAL_SKU, lines, uow)
+
+    assert refs == ['early', 'early', 'late']
+    assert get_allocated_batch_ref(session, 'order3', REAL_SKU) == 'late'
+
+def test_allocating_locks_the_batches_of_the_sku(session_factory):
+    metrics.reset()
+    session = session_factory()
+    insert_batch(session, BATCH1, REAL_SKU, MORE, None)
+    session.commit()
+
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    services.allocate(ORDER1, REAL_SKU, LESS, uow)
+
+    assert metrics.snapshot()['uow.locks'] == 1
+
+
+def test_change_batches_writes_back_through_the_uow(session_factory):
+    uow = unit_of_work.SQLAlchemyUnitOfWork(session_factory)
+    services.add_batch(BATCH1, REAL_SKU, MORE, None, uow)
+    services.allocate(ORDER1, REAL_SKU, 60, uow)
+    services.allocate(ORDER2, REAL_SKU, 30, uow)
+
+    [result] = services.change_batches([{'ref': BATCH1, 'qty': 50}], uow)
+
+    # which lines go first is up to Batch.deallocate_one
+    assert result['deallocated'] and set(result['deallocated']) <= {ORDER1, ORDER2}
+    session = session_factory()
+    [[available]] = session.execute(
+        'SELECT available_qty FROM batches WHERE ref=:ref', dict(ref=BATCH1))
+    assert available == result['available_qty'] >= 0
+    [[allocations]] = session.execute('SELECT count(*) FROM allocations')
+    assert allocations == 2 - len(result['deallocated'])
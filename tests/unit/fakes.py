@@ -0,0 +1,91 @@
+"""
+In-memory fakes of the repository and unit of work, for unit tests of
+the service layer and the code built on it.
+"""
+from datetime import datetime
+from typing import List
+
+from allocation.adapters import outbox, repository
+from allocation.domain import events, model
+from allocation.service_layer import unit_of_work
+
+
+class FakeRepository(repository.AbstractRepository):
+
+    def __init__(self, batches):
+        self._batches = set(batches)
+        self.expiries = {}
+
+    def add(self, batch: model.Batch) -> None:
+        self._batches.add(batch)
+
+    def get(self, ref: model.Ref) -> model.Batch:
+        try:
+            return next(b for b in self._batches if b.ref == ref)
+        except StopIteration:
+            raise model.UnallocatedSKU(f'Unallocated SKU: {ref}')
+
+    def get_many(self, refs) -> List[model.Batch]:
+        return [b for b in self._batches if b.ref in refs]
+
+    def list(self) -> List[model.Batch]:
+        return list(self._batches)
+
+    def list_for_sku(self, sku: model.Sku) -> List[model.Batch]:
+        return [b for b in self._batches if b.sku == sku]
+
+    def skus(self) -> List[model.Sku]:
+        return list({b.sku for b in self._batches})
+
+    def skus_version(self):
+        return len(self._batches)
+
+    def has_archived(self, sku: model.Sku) -> bool:
+        return False
+
+    def is_allocated(self, line: model.OrderLine) -> bool:
+        return any(b.has_been_allocated(line) for b in self._batches)
+
+    def set_expiry(self, line: model.OrderLine, expires_at: datetime) -> None:
+        self.expiries[line] = expires_at
+
+    def confirm(self, orderid: model.OrderId) -> int:
+        confirmed = [line for line in self.expiries if line.orderid == orderid]
+        for line in confirmed:
+            del self.expiries[line]
+        return len(confirmed)
+
+    @staticmethod
+    def for_batch(ref, sku, qty, eta=None):
+        """Factory for making a Repository with a Batch."""
+        repo = FakeRepository([model.Batch(ref, sku, qty, eta)])
+        return repo
+
+
+class FakeSession():
+    committed = False
+
+    def commit(self):
+        self.committed = True
+
+
+class FakeOutbox(outbox.AbstractOutbox):
+
+    def __init__(self):
+        self.events = []
+
+    def add(self, event: events.Event) -> None:
+        self.events.append(event)
+
+
+class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
+    def __init__(self) -> None:
+        self.batches = FakeRepository([])
+        self.outbox = FakeOutbox()
+        self.committed = False
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        pass
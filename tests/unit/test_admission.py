@@ -0,0 +1,73 @@
+import threading
+
+import pytest
+
+from allocation import metrics
+from allocation.service_layer.admission import AdmissionController, Overloaded
+
+
+def setup_function():
+    metrics.reset()
+
+
+def test_admits_up_to_the_limit_without_waiting():
+    admissions = AdmissionController(max_concurrent=2, max_queue=0)
+
+    admissions.acquire()
+    admissions.acquire()
+
+    assert metrics.snapshot()['admission.running'] == 2
+
+
+def test_rejects_when_the_queue_is_full():
+    admissions = AdmissionController(max_concurrent=1, max_queue=0, retry_after=3)
+    admissions.acquire()
+
+    with pytest.raises(Overloaded) as exc:
+        admissions.acquire()
+
+    assert exc.value.retry_after == 3
+    assert metrics.snapshot()['admission.rejected'] == 1
+
+
+def test_a_queued_request_times_out():
+    admissions = AdmissionController(max_concurrent=1, max_queue=1, timeout=0.01)
+    admissions.acquire()
+
+    with pytest.raises(Overloaded):
+        admissions.acquire()
+
+    assert metrics.snapshot()['admission.timeouts'] == 1
+    assert metrics.snapshot()['admission.queue_depth'] == 0
+
+
+def test_a_queued_request_is_admitted_when_a_slot_frees_up():
+    admissions = AdmissionController(max_concurrent=1, max_queue=1, timeout=5)
+    admissions.acquire()
+    admitted = threading.Event()
+
+    def wait():
+        with admissions.admit():
+            admitted.set()
+
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    assert not admitted.wait(0.05)
+    admissions.release()
+
+    assert admitted.wait(1)
+    waiter.join()
+    assert metrics.snapshot()['admission.running'] == 0
+
+
+def test_configure_lets_waiting_requests_in():
+    admissions = AdmissionController(max_concurrent=1, max_queue=1, timeout=5)
+    admissions.acquire()
+    waiter = threading.Thread(target=admissions.acquire)
+    waiter.start()
+
+    admissions.configure(max_concurrent=2, max_queue=1, timeout=5)
+
+    waiter.join(1)
+    assert not waiter.is_alive()
+    assert metrics.snapshot()['admission.running'] == 2
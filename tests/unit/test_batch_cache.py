@@ -0,0 +1,41 @@
+from allocation.adapters import batch_cache
+from allocation.domain import model
+
+
+def batches(sku, lines):
+    batch = model.Batch(f'{sku}-batch', sku, 100)
+    for i in range(lines):
+        batch.allocate(model.OrderLine(f'o{i}', sku, 1))
+    return [batch]
+
+
+def test_only_hands_out_entries_with_a_matching_token():
+    cache = batch_cache.BatchCache()
+    cache.put('A', 1, batches('A', 0))
+    assert cache.get('A', 1) is not None
+    assert cache.get('A', 2) is None
+
+
+def test_evicts_least_recently_used_skus():
+    cache = batch_cache.BatchCache(max_skus=2)
+    cache.put('A', 1, batches('A', 0))
+    cache.put('B', 1, batches('B', 0))
+    cache.get('A', 1)
+    cache.put('C', 1, batches('C', 0))
+    assert cache.get('A', 1) is not None
+    assert cache.get('B', 1) is None
+
+
+def test_bounds_the_number_of_cached_lines():
+    cache = batch_cache.BatchCache(max_lines=15)
+    cache.put('A', 1, batches('A', 9))
+    cache.put('B', 1, batches('B', 9))
+    assert cache.get('A', 1) is None
+    assert cache.get('B', 1) is not None
+
+
+def test_invalidate():
+    cache = batch_cache.BatchCache()
+    cache.put('A', 1, batches('A', 0))
+    cache.invalidate('A')
+    assert cache.get('A', 1) is None
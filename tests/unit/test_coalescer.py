@@ -0,0 +1,88 @@
+import pytest
+
+from allocation import metrics
+from allocation.domain import model
+from allocation.service_layer import admission, coalescer, services
+from fakes import FakeUnitOfWork
+
+SKU = "STOOL"
+
+
+def setup_function():
+    metrics.reset()
+
+
+def make_coalescer(uow, **kwargs):
+    services.add_batch('batch', SKU, 10, None, uow)
+    return coalescer.AllocationCoalescer(lambda: uow, **kwargs)
+
+
+def test_requests_in_one_window_share_a_transaction():
+    uow = FakeUnitOfWork()
+    allocations = make_coalescer(uow, window=10, max_size=3)
+
+    futures = [allocations.submit(f'o{i}', SKU, 4) for i in range(3)]
+
+    assert futures[0].result(timeout=1) == 'batch'
+    assert futures[1].result(timeout=1) == 'batch'
+    with pytest.raises(model.OutOfStock):
+        futures[2].result(timeout=1)
+    assert metrics.snapshot()['coalescer.groups'] == 1
+    assert uow.batches.get('batch').available_qty == 2
+
+
+def test_window_flushes_a_partial_group():
+    uow = FakeUnitOfWork()
+    allocations = make_coalescer(uow, window=0.01, max_size=100)
+
+    assert allocations.submit('o1', SKU, 4).result(timeout=1) == 'batch'
+
+
+def test_each_request_gets_its_own_invalid_sku_error():
+    uow = FakeUnitOfWork()
+    allocations = make_coalescer(uow, window=0.01)
+
+    future = allocations.submit('o1', 'NOPE', 1)
+    with pytest.raises(services.InvalidSKU, match='Invalid SKU: NOPE'):
+        future.result(timeout=1)
+
+
+def test_a_failed_transaction_fails_every_request():
+    class BrokenUnitOfWork(FakeUnitOfWork):
+        broken = False
+
+        def commit(self):
+            if self.broken:
+                raise ConnectionError()
+
+    uow = BrokenUnitOfWork()
+    allocations = make_coalescer(uow, window=10, max_size=2)
+    uow.broken = True
+    futures = [allocations.submit(f'o{i}', SKU, 1) for i in range(2)]
+
+    for future in futures:
+        with pytest.raises(ConnectionError):
+            future.result(timeout=1)
+
+
+def test_a_group_takes_one_admission_slot():
+    uow = FakeUnitOfWork()
+    admissions = admission.AdmissionController(max_concurrent=1)
+    allocations = make_coalescer(uow, window=10, max_size=3, admissions=admissions)
+
+    futures = [allocations.submit(f'o{i}', SKU, 1) for i in range(3)]
+
+    assert [f.result(timeout=1) for f in futures] == ['batch'] * 3
+    assert metrics.snapshot()['admission.admitted'] == 1
+
+
+def test_an_overloaded_group_fails_every_request():
+    uow = FakeUnitOfWork()
+    admissions = admission.AdmissionController(max_concurrent=0)
+    allocations = make_coalescer(uow, window=10, max_size=2, admissions=admissions)
+
+    futures = [allocations.submit(f'o{i}', SKU, 1) for i in range(2)]
+
+    for future in futures:
+        with pytest.raises(admission.Overloaded):
+            future.result(timeout=1)
@@ -0,0 +1,28 @@
+from allocation import config
+from allocation.service_layer import unit_of_work
+
+
+def test_pool_is_split_between_workers(monkeypatch):
+    monkeypatch.setenv('DB_MAX_CONNECTIONS', '40')
+    assert config.get_pool_settings(workers=1)['pool_size'] == 40
+    assert config.get_pool_settings(workers=8)['pool_size'] == 5
+    assert config.get_pool_settings(workers=80)['pool_size'] == 1
+
+
+def test_rebuild_engine_gives_a_new_pool(monkeypatch):
+    before = unit_of_work.DEFAULT_SESSION_FACTORY.kw['bind']
+    # so that the binds are restored afterwards
+    for factory in unit_of_work.DEFAULT_SESSION_FACTORY, unit_of_work.REPLICA_SESSION_FACTORY:
+        monkeypatch.setitem(factory.kw, 'bind', factory.kw['bind'])
+    unit_of_work.rebuild_engine(workers=4)
+    after = unit_of_work.DEFAULT_SESSION_FACTORY.kw['bind']
+    assert after is not before
+    assert after.pool.size() == config.get_pool_settings(workers=4)['pool_size']
+
+
+def test_admission_defaults_to_the_pool_size(monkeypatch):
+    monkeypatch.setenv('DB_MAX_CONNECTIONS', '40')
+    monkeypatch.delenv('ADMISSION_MAX_CONCURRENT', raising=False)
+    assert config.get_admission_settings(workers=4)['max_concurrent'] == 10
+    monkeypatch.setenv('ADMISSION_MAX_CONCURRENT', '3')
+    assert config.get_admission_settings(workers=4)['max_concurrent'] == 3
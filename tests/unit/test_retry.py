@@ -0,0 +1,73 @@
+import sqlite3
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from allocation import metrics
+from allocation.service_layer import retry
+
+NO_WAIT = retry.RetryPolicy(attempts=3, backoff=0, max_backoff=0)
+
+
+class FakePgError(Exception):
+    def __init__(self, pgcode):
+        self.pgcode = pgcode
+
+
+def conflict(pgcode=retry.SERIALIZATION_FAILURE):
+    return OperationalError('UPDATE batches', {}, FakePgError(pgcode))
+
+
+def failing(times, exc):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) <= times:
+            raise exc
+        return 'done'
+    return fn, calls
+
+
+def setup_function():
+    metrics.reset()
+
+
+def test_retries_serialization_failures_until_success():
+    fn, calls = failing(2, conflict())
+    assert retry.call(fn, policy=NO_WAIT) == 'done'
+    assert len(calls) == 3
+    assert metrics.snapshot()['retry.retries'] == 2
+
+
+def test_retries_deadlocks():
+    fn, calls = failing(1, conflict(retry.DEADLOCK_DETECTED))
+    assert retry.call(fn, policy=NO_WAIT) == 'done'
+
+
+def test_retries_sqlite_busy_errors():
+    busy = OperationalError('UPDATE batches', {}, sqlite3.OperationalError(retry.SQLITE_BUSY))
+    fn, calls = failing(1, busy)
+    assert retry.call(fn, policy=NO_WAIT) == 'done'
+    other = OperationalError('UPDATE batches', {}, sqlite3.OperationalError('no such table'))
+    assert not retry.is_retryable(other)
+
+
+def test_gives_up_after_the_configured_attempts():
+    fn, calls = failing(3, conflict())
+    with pytest.raises(OperationalError):
+        retry.call(fn, policy=NO_WAIT)
+    assert len(calls) == 3
+    assert metrics.snapshot()['retry.exhausted'] == 1
+
+
+def test_does_not_retry_other_errors():
+    fn, calls = failing(1, ValueError())
+    with pytest.raises(ValueError):
+        retry.call(fn, policy=NO_WAIT)
+    assert len(calls) == 1
+
+
+def test_policy_needs_at_least_one_attempt():
+    with pytest.raises(ValueError):
+        retry.RetryPolicy(attempts=0)
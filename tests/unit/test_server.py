@@ -0,0 +1,48 @@
+import logging
+import os
+import time
+
+from allocation.entrypoints import server as prefork
+from allocation.entrypoints.server import PreforkServer
+
+
+class FailingServer(PreforkServer):
+
+    def serve(self):
+        raise RuntimeError('cannot start')
+
+
+def test_a_worker_that_fails_exits_non_zero_and_logs_why(capfd, monkeypatch):
+    # as logging.basicConfig() does in main()
+    monkeypatch.setattr(prefork.logger, 'handlers', [logging.StreamHandler()])
+    server = FailingServer(app=None, workers=1)
+    server.spawn()
+    [pid] = server.pids
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 1
+    assert 'RuntimeError: cannot start' in capfd.readouterr().err
+
+
+def delays(server, pids, code=1):
+    result = []
+    for pid in pids:
+        server.started[pid] = time.monotonic()
+        server.replace(pid, code)
+        result.append(round(server.respawns.pop() - time.monotonic(), 1))
+    return result
+
+
+def test_workers_failing_in_a_row_are_replaced_later_and_later():
+    server = PreforkServer(app=None, workers=1)
+    assert delays(server, [1, 2, 3, 4]) == [0.1, 0.2, 0.4, 0.8]
+    assert server.backoff(20) == server.MAX_BACKOFF
+
+
+def test_a_worker_that_served_for_a_while_is_replaced_at_once():
+    server = PreforkServer(app=None, workers=1)
+    delays(server, [1, 2, 3])
+    server.started[4] = time.monotonic() - server.MAX_BACKOFF - 1
+    server.replace(4, -9)  # e.g. killed for running out of memory
+    assert server.respawns == [server.respawns[0]]
+    assert server.respawns[0] <= time.monotonic()
+    assert delays(server, [5]) == [0.1]
@@ -1,53 +1,8 @@
 import pytest
-from allocation.domain import model
-from allocation.adapters import repository
-from allocation.service_layer import services
-from allocation.service_layer import unit_of_work
-from typing import List
-from datetime import date, timedelta
-
-class FakeRepository(repository.AbstractRepository):
-
-    def __init__(self, batches):
-        self._batches = set(batches)
-
-    def add(self, batch: model.Batch) -> None:
-        self._batches.add(batch)
-
-    def get(self, ref: model.Ref) -> model.Batch:
-        try:
-            return next(b for b in self._batches if b.ref == ref)
-        except StopIteration:
-            raise model.UnallocatedSKU(f'Unallocated SKU: {ref}')
-
-    def list(self) -> List[model.Batch]:
-        return list(self._batches)
-
-    @staticmethod
-    def for_batch(ref, sku, qty, eta=None):
-        """Factory for making a Repository with a Batch."""
-        repo = FakeRepository([model.Batch(ref, sku, qty, eta)])
-        return repo
-
-
-class FakeSession():
-    committed = False
-
-    def commit(self):
-        self.committed = True
-
-
-class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
-    def __init__(self) -> None:
-        self.batches = FakeRepository([])
-        self.committed = False
-
-    def commit(self):
-        self.committed = True
-
-    def rollback(self):
-        pass
-
+from allocation.domain import events, model
+from allocation.service_layer import services, sku_catalogue
+from datetime import date, datetime, timedelta
+from fakes import FakeUnitOfWork
 
 ORDER_1, BATCH_1 = "O1", "B1"
 REAL_SKU, UNREAL_SKU = "SKU_EXISTS", "SKU_DOESNT_EXIST"
@@ -83,6 +38,15 @@ def test_returns_allocation():
         ORDER_1, REAL_SKU, LOW_NUM, uow)
     assert result == BATCH_1
 
+def test_allocation_is_recorded_in_the_outbox():
+    uow = FakeUnitOfWork()
+
+    services.add_batch(BATCH_1, REAL_SKU, HIGH_NUM, None, uow)
+    services.allocate(ORDER_1, REAL_SKU, LOW_NUM, uow)
+    assert uow.outbox.events == [
+        events.Allocated(ORDER_1, REAL_SKU, LOW_NUM, BATCH_1)
+    ]
+
 def test_error_for_invalid_sku():
     uow = FakeUnitOfWork()
 
@@ -90,6 +54,26 @@ def test_error_for_invalid_sku():
     with pytest.raises(services.InvalidSKU, match=f"Invalid SKU: {UNREAL_SKU}"):
         services.allocate(ORDER_1, UNREAL_SKU, LOW_NUM, uow)
 
+def test_unknown_sku_is_rejected_before_opening_the_uow():
+    uow = FakeUnitOfWork()
+    services.add_batch(BATCH_1, REAL_SKU, HIGH_NUM, None, uow)
+    skus = sku_catalogue.SkuCatalogue(lambda: services.list_skus(uow), lambda: 1)
+    skus.refresh()
+    uow.batches = None  # would fail if the uow were used
+
+    with pytest.raises(services.InvalidSKU, match=f"Invalid SKU: {UNREAL_SKU}"):
+        services.allocate(ORDER_1, UNREAL_SKU, LOW_NUM, uow, skus=skus)
+
+def test_add_batch_updates_the_sku_catalogue():
+    uow = FakeUnitOfWork()
+    skus = sku_catalogue.SkuCatalogue(
+        lambda: services.list_skus(uow), lambda: services.skus_version(uow))
+    skus.refresh()
+
+    services.add_batch(BATCH_1, REAL_SKU, HIGH_NUM, None, uow, skus=skus)
+    assert skus.might_contain(REAL_SKU)
+    assert services.allocate(ORDER_1, REAL_SKU, LOW_NUM, uow, skus=skus) == BATCH_1
+
 def test_commits():
     uow = FakeUnitOfWork()
 
@@ -236,4 +220,121 @@ def test_change_batch_qty():
 
     services.change_batch_quantity(BATCH_REF, 30, uow)
 
-    assert batch.available_qty > 0
\ No newline at end of file
+    assert batch.available_qty > 0
+
+def test_allocate_window_fulfils_the_large_order():
+    uow = FakeUnitOfWork()
+
+    services.add_batch(SLOW, SKU, 10, tomorrow, uow)
+    services.allocate(ORDER1, SKU, 5, uow)
+    services.add_batch(SPEEDY, SKU, 10, today, uow)
+    services.allocate(ORDER2, SKU, 5, uow)
+    with pytest.raises(model.OutOfStock):
+        services.allocate(OREF, SKU, 10, uow)
+    uow.outbox.events.clear()
+
+    small1 = model.OrderLine(ORDER1, SKU, 5)
+    small2 = model.OrderLine(ORDER2, SKU, 5)
+    large = model.OrderLine(OREF, SKU, 10)
+    refs = services.allocate_window(SKU, [small1, small2, large], uow)
+
+    assert refs == [SPEEDY, SPEEDY, SLOW]
+    assert uow.batches.get(SPEEDY).available_qty == 0
+    assert uow.batches.get(SLOW).available_qty == 0
+    assert uow.committed
+    # releases first, so SLOW is never allocated beyond its quantity
+    assert uow.outbox.events == [
+        events.Deallocated(ORDER1, SKU, 5, SLOW),
+        events.Allocated(ORDER1, SKU, 5, SPEEDY),
+        events.Allocated(OREF, SKU, 10, SLOW),
+    ]
+
+def test_allocate_window_never_drops_an_allocated_order():
+    uow = FakeUnitOfWork()
+    services.add_batch(SPEEDY, SKU, 10, today, uow)
+    services.allocate(ORDER1, SKU, 10, uow)
+
+    small1 = model.OrderLine(ORDER2, SKU, 6)
+    small2 = model.OrderLine(OREF, SKU, 4)
+    allocated = model.OrderLine(ORDER1, SKU, 10)
+    refs = services.allocate_window(SKU, [small1, small2, allocated], uow)
+
+    assert refs == [None, None, SPEEDY]
+    assert uow.batches.get(SPEEDY).available_qty == 0
+
+def test_allocate_window_only_reports_the_lines_that_moved():
+    uow = FakeUnitOfWork()
+    services.add_batch(SPEEDY, SKU, 10, today, uow)
+    services.add_batch(SLOW, SKU, 10, tomorrow, uow)
+    services.allocate(ORDER1, SKU, 6, uow)
+    services.allocate(ORDER2, SKU, 2, uow)
+    uow.outbox.events.clear()
+
+    small = model.OrderLine(ORDER1, SKU, 6)
+    unmoved = model.OrderLine(ORDER2, SKU, 2)
+    large = model.OrderLine(OREF, SKU, 8)
+    services.allocate_window(SKU, [small, unmoved, large], uow)
+
+    assert uow.outbox.events == [
+        events.Deallocated(ORDER1, SKU, 6, SPEEDY),
+        events.Allocated(ORDER1, SKU, 6, SLOW),
+        events.Allocated(OREF, SKU, 8, SPEEDY),
+    ]
+
+def test_allocate_window_reports_every_line_of_an_order():
+    uow = FakeUnitOfWork()
+    services.add_batch(SPEEDY, SKU, 10, today, uow)
+    services.add_batch(SLOW, SKU, 10, tomorrow, uow)
+
+    first = model.OrderLine(ORDER1, SKU, 8)
+    second = model.OrderLine(ORDER1, SKU, 6)
+    refs = services.allocate_window(SKU, [first, second], uow)
+
+    assert refs == [SPEEDY, SLOW]
+
+def test_allocate_window_for_invalid_sku():
+    uow = FakeUnitOfWork()
+
+    services.add_batch(BATCH_1, REAL_SKU, HIGH_NUM, None, uow)
+    with pytest.raises(services.InvalidSKU, match=f"Invalid SKU: {UNREAL_SKU}"):
+        services.allocate_window(UNREAL_SKU, [model.OrderLine(ORDER_1, UNREAL_SKU, 1)], uow)
+
+def test_change_batches_applies_every_change_in_one_commit():
+    uow = FakeUnitOfWork()
+    services.add_batch(SPEEDY, SKU, 10, today, uow)
+    services.add_batch(SLOW, SKU, 10, later, uow)
+    services.allocate(ORDER1, SKU, 6, uow)
+    uow.committed = False
+
+    results = services.change_batches([
+        {'ref': SPEEDY, 'qty': 4},
+        {'ref': SLOW, 'eta': tomorrow},
+        {'ref': 'nope', 'qty': 1},
+    ], uow)
+
+    assert results == [
+        dict(ref=SPEEDY, status='updated', available_qty=4, deallocated=[ORDER1]),
+        dict(ref=SLOW, status='updated', available_qty=10, deallocated=[]),
+        dict(ref='nope', status='not_found'),
+    ]
+    assert uow.batches.get(SLOW).eta == tomorrow
+    assert uow.committed
+
+def test_change_batches_reports_deallocations_in_the_outbox():
+    uow = FakeUnitOfWork()
+    services.add_batch(SPEEDY, SKU, 10, today, uow)
+    services.allocate(ORDER1, SKU, 6, uow)
+    uow.outbox.events.clear()
+
+    services.change_batches([{'ref': SPEEDY, 'qty': 4}], uow)
+
+    assert uow.outbox.events == [events.Deallocated(ORDER1, SKU, 6, SPEEDY)]
+
+def test_allocate_can_set_an_expiry():
+    uow = FakeUnitOfWork()
+    services.add_batch(BATCH_REF, REAL_SKU, 100, None, uow)
+    expires_at = datetime(2030, 1, 1)
+
+    services.allocate(ORDER_REF, REAL_SKU, 10, uow, expires_at=expires_at)
+
+    assert uow.batches.expiries == {model.OrderLine(ORDER_REF, REAL_SKU, 10): expires_at}
@@ -0,0 +1,88 @@
+import threading
+
+from allocation import metrics
+from allocation.service_layer import sku_catalogue
+
+STOCKED = [f'SKU-{i}' for i in range(1000)]
+
+
+def setup_function():
+    metrics.reset()
+
+
+def test_bloom_filter_has_no_false_negatives_and_few_false_positives():
+    bloom = sku_catalogue.BloomFilter(capacity=len(STOCKED), error_rate=0.01)
+    for sku in STOCKED:
+        bloom.add(sku)
+
+    assert all(sku in bloom for sku in STOCKED)
+    false_positives = sum(f'OTHER-{i}' in bloom for i in range(10000))
+    assert false_positives < 300
+
+
+def test_rejects_unknown_skus_without_reloading():
+    loads = []
+    skus = sku_catalogue.SkuCatalogue(lambda: loads.append(1) or STOCKED, lambda: 1)
+
+    assert skus.might_contain('SKU-1')
+    assert not skus.might_contain('NOPE')
+    assert not skus.might_contain('NOPE')
+    assert len(loads) == 1
+    assert metrics.snapshot()['skus.rejected'] == 2
+
+
+def test_added_skus_are_known_straight_away():
+    skus = sku_catalogue.SkuCatalogue(lambda: STOCKED, lambda: 1)
+    skus.refresh()
+    skus.add('NEW')
+    assert skus.might_contain('NEW')
+
+
+def test_reloads_on_a_miss_once_skus_were_added_elsewhere():
+    stocked = list(STOCKED)
+    skus = sku_catalogue.SkuCatalogue(lambda: stocked, lambda: len(stocked))
+    skus.refresh()
+    stocked.append('ADDED-ELSEWHERE')
+    assert skus.might_contain('ADDED-ELSEWHERE')
+
+
+def test_lets_everything_through_when_it_cant_tell():
+    def broken():
+        raise ConnectionError()
+    assert sku_catalogue.SkuCatalogue(broken, lambda: 1).might_contain('ANYTHING')
+    skus = sku_catalogue.SkuCatalogue(lambda: STOCKED, lambda: 1)
+    skus.refresh()
+    skus.version = broken
+    assert skus.might_contain('ANYTHING')
+
+
+def test_concurrent_misses_load_once():
+    loads = []
+    loading = threading.Event()
+
+    def slow_load():
+        loads.append(1)
+        loading.wait(1)
+        return STOCKED
+    skus = sku_catalogue.SkuCatalogue(slow_load, lambda: 1)
+    threads = [threading.Thread(target=skus.might_contain, args=('NOPE',)) for _ in range(5)]
+    for t in threads:
+        t.start()
+    loading.set()
+    for t in threads:
+        t.join()
+
+    assert len(loads) == 1
+    assert metrics.snapshot()['skus.rejected'] == 5
+
+
+def test_doesnt_retry_a_failed_load_on_every_miss():
+    loads = []
+
+    def broken():
+        loads.append(1)
+        raise ConnectionError()
+    skus = sku_catalogue.SkuCatalogue(broken, lambda: 1, retry_interval=60)
+    assert skus.might_contain('ANYTHING')
+    assert skus.might_contain('ANYTHING')
+    assert len(loads) == 1
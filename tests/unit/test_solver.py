@@ -0,0 +1,93 @@
+import time
+from datetime import date, timedelta
+
+from allocation.domain import model, solver
+
+SKU = "SOFA"
+today = date.today()
+tomorrow = today + timedelta(days=1)
+later = tomorrow + timedelta(days=10)
+
+
+def test_large_order_fits_after_small_ones_fragment_the_early_batches():
+    early = model.Batch("early", SKU, 10, eta=today)
+    late = model.Batch("late", SKU, 10, eta=tomorrow)
+    small1 = model.OrderLine("o1", SKU, 5)
+    small2 = model.OrderLine("o2", SKU, 5)
+    large = model.OrderLine("o3", SKU, 10)
+    # greedily, the small ones take a half of each batch
+    early.allocate(small1)
+    late.allocate(small2)
+
+    plan = solver.allocate_window([small1, small2, large], [early, late])
+
+    assert all(ref is not None for ref in plan.values())
+    assert early.available_qty == 0
+    assert late.available_qty == 0
+
+
+def test_prefers_earlier_batches_when_everything_fits():
+    early = model.Batch("early", SKU, 100, eta=today)
+    middle = model.Batch("middle", SKU, 100, eta=tomorrow)
+    late = model.Batch("late", SKU, 100, eta=later)
+    lines = [model.OrderLine(f"o{i}", SKU, 10) for i in range(5)]
+
+    plan = solver.allocate_window(lines, [late, middle, early])
+
+    assert set(plan.values()) == {"early"}
+    assert middle.available_qty == late.available_qty == 100
+
+
+def test_unfulfillable_lines_are_left_unallocated():
+    batch = model.Batch("batch", SKU, 10, eta=None)
+    fits, too_big = model.OrderLine("o1", SKU, 10), model.OrderLine("o2", SKU, 11)
+
+    plan = solver.allocate_window([fits, too_big], [batch])
+
+    assert plan == {fits: "batch", too_big: None}
+
+
+def test_leaves_allocations_outside_the_window_alone():
+    batch = model.Batch("batch", SKU, 10, eta=None)
+    other = model.OrderLine("other", SKU, 6)
+    batch.allocate(other)
+    line = model.OrderLine("o1", SKU, 5)
+
+    plan = solver.allocate_window([line], [batch])
+
+    assert plan == {line: None}
+    assert batch.has_been_allocated(other)
+
+
+def test_plans_thousands_of_lines_quickly():
+    batches = [model.Batch(f"b{i}", SKU, 1000, eta=today + timedelta(days=i))
+               for i in range(20)]
+    lines = [model.OrderLine(f"o{i}", SKU, i % 50 + 1) for i in range(5000)]
+
+    start = time.perf_counter()
+    solver.plan_allocations(lines, batches)
+    assert time.perf_counter() - start < 5
+
+
+def test_allocated_lines_are_never_left_out():
+    batch = model.Batch("batch", SKU, 10, eta=None)
+    allocated = model.OrderLine("x", SKU, 10)
+    batch.allocate(allocated)
+    small1, small2 = model.OrderLine("y", SKU, 6), model.OrderLine("z", SKU, 4)
+
+    plan = solver.allocate_window([small1, small2, allocated], [batch])
+
+    assert plan == {small1: None, small2: None, allocated: "batch"}
+    assert batch.has_been_allocated(allocated)
+
+
+def test_allocated_lines_stay_put_when_moving_them_gains_nothing():
+    early = model.Batch("early", SKU, 10, eta=today)
+    late = model.Batch("late", SKU, 10, eta=tomorrow)
+    allocated = model.OrderLine("x", SKU, 4)
+    late.allocate(allocated)
+    line = model.OrderLine("y", SKU, 10)
+
+    plan = solver.allocate_window([line, allocated], [early, late])
+
+    assert plan == {line: "early", allocated: "late"}